@@ -1,10 +1,11 @@
 import streamlit as st
-import geopandas as gpd
+import streamlit.components.v1 as components
 import folium
-from streamlit_folium import folium_static
-import numpy as np
-from utils import count_houses, plot_ratio_map
-import matplotlib.pyplot as plt
+from streamlit_folium import st_folium
+from drilldown import DRILLDOWN_ZOOM, build_drilldown_group
+from rendering import DIVISIONS, TYPES, cached_view, data_version
+from app_data import snapshot_dates
+from export_maps import LATEST
 
 
 
@@ -14,149 +15,41 @@ st.set_page_config(
     layout="wide",
 )
 
-# Data preprocessing
-
-censal = gpd.read_file('data/censal_sections.geojson')
-barris = gpd.read_file('data/barris.geojson')
-districts = gpd.read_file('data/districts.geojson')
-edges = gpd.read_file('data/edges.geojson')
-
 st.title("Percentage of Airbnb's in Barcelona")
 st.text("You can select different divisions and types of Airbnb rentals to explore the data and see how much housing"
          " is devoted to Airbnb in different areas of the city."
          )
 # Division selection
-division = st.selectbox("Select a division", options=["Censal Sections", "Neighborhoods", "Districts"])
+division = st.selectbox("Select a division", options=list(DIVISIONS))
 # Type selection
-type = st.selectbox("Select a type of Airbnb rental", options=["All", "Full aparments", "Rooms"])
+type = st.selectbox("Select a type of Airbnb rental", options=list(TYPES))
+# Computed first, so the layers and time series of an older data version are dropped before any is read
+version = data_version()
+# Snapshot selection, when the time series of the listing snapshots was built
+dates = snapshot_dates()
+# The latest option stands for the current data, with the views precomputed when the data is updated
+date = st.selectbox("Select a snapshot date", options=[LATEST] + dates) if dates else LATEST
+date = None if date == LATEST else date
 
 if division == "Districts":
-    gdf = districts
     st.write("Districts of Barcelona")
 elif division == "Neighborhoods":
-    gdf = barris
     st.write("Neighborhoods of Barcelona")
 else:
-    gdf = censal
     st.write("Censal Sections of Barcelona")
 
-if type == "Full aparments":
-    col = 'ratio_flats'
-elif type == "Rooms":
-    col = 'ratio_rooms'
-elif type == "All":
-    col = 'ratio'
-
-
-# Ensure unique index for matching
-gdf = gdf.reset_index(drop=True)
-gdf.index.name = 'id'  # Choropleth will use this as feature.id
-gdf[col] = gdf[col].astype(float).round(1) # Ensure the column is float and rounded to 1 decimal place
-
-
-
-
-# Create Folium map
-m = folium.Map(
-    location=[41.3874, 2.1686],
-    zoom_start=13,
-    tiles='CartoDB positron'
-)
-
-
-# Add choropleth
-folium.Choropleth(
-    geo_data=gdf,
-    data=gdf,
-    columns=[gdf.index, col],
-    key_on='feature.id',
-    fill_color='Reds',
-    fill_opacity=0.7,
-    line_opacity=0.2,
-    legend_name='Percentage of Airbnb',
-    highlight=True,
-).add_to(m)
-
-folium.GeoJson(
-    gdf,
-    tooltip=folium.GeoJsonTooltip(fields=[col], aliases=["%:"]),
-    style_function=lambda feature: {
-        'fillOpacity': 0,
-        'color': 'transparent'
-    }
-).add_to(m) # Add GeoJson for tooltips
-
-# Prepare top 30 censal sections by ratio
-top_censals = censal.sort_values(col, ascending=False).head(30)
-# Format x-axis labels as percentages
-# Create the plot
-fig, ax = plt.subplots(figsize=(10, 10))
-# Set font sizes for title and axis labels
-title_fontsize = 20
-label_fontsize = 16
-# Increase font size for labels
-ax.tick_params(axis='y', labelsize=label_fontsize)
-ax.tick_params(axis='x', labelsize=label_fontsize)
-# Horizontal bar plot
-ax.barh(top_censals['NOM'], top_censals[col], color=plt.cm.Reds(top_censals[col] / top_censals[col].max()))
-
-# Labels and title
-ax.set_title("Top 30 Censal Sections by %", fontsize=title_fontsize)
-ax.set_xlabel(f"Percentage of {type}", fontsize=label_fontsize)
-ax.set_ylabel("Neighborhood", fontsize=label_fontsize)
-ax.set_xticklabels([f"{x:.0f}%" for x in ax.get_xticks()])
-# Invert y-axis to show the highest ratio on top
-ax.invert_yaxis()
-
-
+# Map HTML and figures come from the render cache, keyed by (division, type, data version, date)
+view = cached_view(division, type, version, date)
 
 
 col1, col2 = st.columns(2)
 
 with col1:
-    folium_static(m, width=600, height=500)
+    components.html(view['map_html'], width=600, height=500)
 
 with col2:
-    st.pyplot(fig)
+    st.image(view['top_png'], use_container_width=True)
  
-# Filter hotspots
-hottest = censal[censal[col] > 5]
-# Create figure
-fig_map, ax_map = plt.subplots(figsize=(10, 10))
-# Plot background edges
-edges.plot(ax=ax_map, alpha=0.4, color='grey')
-# Plot the values
-plot_ratio_map(hottest, censal, ax_map, ratio_col=col)
-
-ax_map.set_title("A closer look at the most problematic areas", fontsize=title_fontsize)
-ax_map.set_xlabel("Percentage", fontsize=label_fontsize)
-ax_map.set_ylabel("Censal Section", fontsize=label_fontsize)
-ax_map.tick_params(axis='y', labelsize=label_fontsize)
-ax_map.tick_params(axis='x', labelsize=label_fontsize)
-
-# Annotate places
-annotations = [
-        (2.1742309820379906, 41.403593049470885, "Sagrada Familia"),
-        (2.169841171395862, 41.38688665835762, "Plaça Catalunya"),
-        (2.188651884769526, 41.379463437793035, "La Barceloneta"),
-        (2.1633058193393004, 41.36641505140188, "Montjuïc")
-    ]
-for x, y, name in annotations:
-    ax_map.text(
-        x, y, name,
-        fontsize=16,
-        fontweight='bold',
-        color='black',
-        ha='center',
-        va='center',
-        bbox=dict(
-            facecolor='white',   # Background color
-            edgecolor='none',    # No border
-            boxstyle='round,pad=0.3',  # Rounded box with padding
-            alpha=0.6           # Slight transparency (optional)
-        )
-    )
-
 
 
 # Show the plot in Streamlit
@@ -167,7 +60,7 @@ st.write("")
 col1, col2 = st.columns(2)
 
 with col1:
-    st.pyplot(fig_map)
+    st.image(view['hotspot_png'], use_container_width=True)
 
 with col2:
     st.write("")
@@ -181,6 +74,27 @@ with col2:
                 "\n\nThose areas with a high concentration of Airbnb rentals can be considered as 'parasites' in the sense that they are taking away apartments from local residents,"
                 " leading to a decrease in the availability of affordable housing for locals." )
 
+# Building-level drill-down: only the parcels and listings of the viewport are read, once zoomed in
+st.markdown("### Building by building")
+st.text(f"Zoom in to level {DRILLDOWN_ZOOM} or closer to see the dwellings and Airbnb listings of every building in view.")
+if 'viewport' not in st.session_state:
+    st.session_state['viewport'] = {'bbox': None, 'zoom': None}
+viewport = st.session_state['viewport']
+group, message = build_drilldown_group(viewport['bbox'], viewport['zoom'])
+
+# The base map is the same on every run, so the browser keeps its view and only the layer is replaced
+base = folium.Map(location=[41.3874, 2.1686], zoom_start=13, tiles='CartoDB positron')
+state = st_folium(base, feature_group_to_add=group, key='drilldown', height=500, use_container_width=True,
+                  returned_objects=['bounds', 'zoom'])
+st.caption(message)
+
+bounds = (state or {}).get('bounds') or {}
+if bounds.get('_southWest') and bounds.get('_northEast'):
+    bbox = (bounds['_southWest']['lng'], bounds['_southWest']['lat'], bounds['_northEast']['lng'], bounds['_northEast']['lat'])
+    if (bbox, state.get('zoom')) != (viewport['bbox'], viewport['zoom']):
+        st.session_state['viewport'] = {'bbox': bbox, 'zoom': state.get('zoom')}
+        st.rerun()
+
 st.markdown("### Methodology:\n\nThese results have been generated by counting the number of Airbnb rentals in each censal section and dividing it by the total number of houses/apartments in that section."
         " All data is open access. Housing data can be obtained from the [Spanish cadaster Inspire system](https://www.catastro.hacienda.gob.es/webinspire/index.html),"
         " while Airbnb data is available through the [Inside Airbnb project](http://insideairbnb.com/get-the-data.html). The dataset used here includes all "
@@ -0,0 +1,218 @@
+import os
+import threading
+from functools import lru_cache
+import geopandas as gpd
+import pandas as pd
+import shapely
+from timeseries import COUNT_COLS, RATIO_COLS, division_code
+from density import read_surfaces
+
+
+# Source files written by data_preprocessing.py
+LAYERS = {
+    'censal': 'data/censal_sections.geojson',
+    'barris': 'data/barris.geojson',
+    'districts': 'data/districts.geojson',
+    'edges': 'data/edges.parquet',
+}
+
+EDGES_PATH = LAYERS['edges']
+HOTSPOT_THRESHOLD = 5 # Percentage above which a censal section is shown in the hotspot map
+
+# Geometry variants served for each layer, as simplification tolerances in degrees (None keeps full detail)
+VARIANTS = {
+    'map': 0.00005,
+}
+
+CACHE_DIR = 'data/cache'
+TIMESERIES_PATH = 'data/timeseries.parquet' # Counts per snapshot date, written by data_preprocessing.py
+DENSITY_PATH = 'data/density.npz' # Hotspot surfaces per ratio column, written by data_preprocessing.py
+
+# Spatially sorted GeoParquet stores of the parcels and listings, read by viewport for the drill-down
+PARCEL_STORE = 'data/parcels.parquet'
+LISTING_STORE = 'data/listings.parquet'
+ROW_GROUP_SIZE = 5_000 # Features per row group; each row group covers a compact area, so a viewport reads a few
+
+_layer_lock = threading.Lock() # Serializes the rebuilds of the variants between the threads of a process
+
+
+
+def variant_path(name: str, variant: str = 'map', cache_dir: str = CACHE_DIR) -> str:
+    """
+    Path of the GeoParquet file holding a geometry variant of a layer.
+    """
+    return os.path.join(cache_dir, f"{name}.{variant}.parquet")
+
+
+
+def hotspot_edges_path(col: str, edges_path: str = EDGES_PATH) -> str:
+    """
+    Path of the street edges clipped to the hotspot extent of a ratio column.
+    """
+    stem, ext = os.path.splitext(edges_path)
+    return f"{stem}_{col}{ext}"
+
+
+
+def build_layer_cache(name: str, cache_dir: str = CACHE_DIR) -> None:
+    """
+    Reads the GeoJSON of a layer once and writes every geometry variant as GeoParquet.
+
+    Each file is written under a temporary name and then renamed, so readers, in this or another
+    process, never see a partly written variant.
+
+    Parameters:
+    - name: Key of the layer in LAYERS.
+    - cache_dir: Directory holding the GeoParquet files.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    source = LAYERS[name]
+    gdf = gpd.read_parquet(source) if source.endswith('.parquet') else gpd.read_file(source)
+    for variant, tolerance in VARIANTS.items():
+        out = gdf
+        if tolerance is not None:
+            out = gdf.copy()
+            out.geometry = shapely.simplify(gdf.geometry.values.to_numpy(), tolerance, preserve_topology=True)
+        path = variant_path(name, variant, cache_dir)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        out.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+
+
+
+def build_all_layer_caches(cache_dir: str = CACHE_DIR) -> None:
+    """
+    Builds the GeoParquet variants of every layer whose GeoJSON exists.
+    """
+    for name, path in LAYERS.items():
+        if os.path.exists(path):
+            build_layer_cache(name, cache_dir)
+
+
+
+@lru_cache(maxsize=None)
+def load_layer(name: str, variant: str = 'map', cache_dir: str = CACHE_DIR) -> gpd.GeoDataFrame:
+    """
+    Loads a geometry variant of a layer once per process.
+
+    The GeoParquet variants are rebuilt from the GeoJSON when missing or older than it, by one thread
+    at a time. The returned GeoDataFrame is shared between callers and must not be modified in place.
+
+    Parameters:
+    - name: Key of the layer in LAYERS.
+    - variant: Key of the geometry variant in VARIANTS.
+    - cache_dir: Directory holding the GeoParquet files.
+
+    Returns:
+    - GeoDataFrame with the requested layer.
+    """
+    path = variant_path(name, variant, cache_dir)
+    source = LAYERS[name]
+    with _layer_lock:
+        # Checked under the lock, so threads waiting on a rebuild find the variant fresh and read it
+        if not os.path.exists(path) or (os.path.exists(source) and os.path.getmtime(path) < os.path.getmtime(source)):
+            build_layer_cache(name, cache_dir)
+    return gpd.read_parquet(path)
+
+
+
+@lru_cache(maxsize=None)
+def load_hotspot_edges(col: str) -> gpd.GeoDataFrame:
+    """
+    Loads once per process the street edges precomputed for the hotspot map of a ratio column,
+    falling back to the whole network if they were not precomputed.
+    """
+    path = hotspot_edges_path(col)
+    if os.path.exists(path):
+        return gpd.read_parquet(path)
+    return load_layer('edges', 'map')
+
+
+
+@lru_cache(maxsize=None)
+def load_timeseries(path: str = TIMESERIES_PATH) -> pd.DataFrame:
+    """
+    Loads once per process the long-format time series of the listing snapshots, empty if it was not built.
+    """
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=['date', 'division', 'code', 'NOM'] + COUNT_COLS + RATIO_COLS)
+    return pd.read_parquet(path)
+
+
+
+def snapshot_dates() -> list:
+    """
+    Sorted snapshot dates of the time series.
+    """
+    return sorted(load_timeseries()['date'].unique())
+
+
+
+def layer_at(name: str, date: str, variant: str = 'map') -> gpd.GeoDataFrame:
+    """
+    Geometry variant of a division with the counts and ratios of a snapshot date of the time series.
+
+    Parameters:
+    - name: 'censal', 'barris' or 'districts'.
+    - date: Snapshot date, one of `snapshot_dates()`.
+    - variant: Key of the geometry variant in VARIANTS.
+
+    Returns:
+    - Copy of the layer whose count and ratio columns hold the values of that date.
+    """
+    series = load_timeseries()
+    series = series[(series['date'] == date) & (series['division'] == name)].set_index('code')
+    layer = load_layer(name, variant).copy()
+    codes = division_code(layer, name)
+    for col in COUNT_COLS + RATIO_COLS:
+        layer[col] = codes.map(series[col]).to_numpy()
+    return layer
+
+
+
+@lru_cache(maxsize=None)
+def load_density(path: str = DENSITY_PATH) -> dict:
+    """
+    Loads once per process the hotspot surfaces, keyed by ratio column (empty if they were not built).
+    """
+    return read_surfaces(path) if os.path.exists(path) else {}
+
+
+
+def build_store(gdf: gpd.GeoDataFrame, path: str, row_group_size: int = ROW_GROUP_SIZE) -> None:
+    """
+    Writes a GeoParquet store that can be read by bounding box without loading the rest.
+
+    Features are sorted along a Hilbert curve, so every row group covers a compact area, and a
+    bounding box column is written, whose row group statistics let readers skip the row groups
+    outside a viewport.
+    """
+    gdf = gdf.iloc[gdf.hilbert_distance().argsort()]
+    gdf.to_parquet(path, index=False, write_covering_bbox=True, row_group_size=row_group_size)
+
+
+
+def read_viewport(path: str, bbox, columns=None) -> gpd.GeoDataFrame:
+    """
+    Reads the features of a store written by `build_store` intersecting a bounding box.
+
+    Parameters:
+    - path: GeoParquet store.
+    - bbox: (minx, miny, maxx, maxy) in EPSG:4326.
+    - columns: Columns to read besides the geometry (None reads all).
+
+    Returns:
+    - GeoDataFrame with the features whose bounding box intersects `bbox`.
+    """
+    if columns is not None:
+        columns = list(columns) + ['geometry']
+    return gpd.read_parquet(path, bbox=tuple(bbox), columns=columns)
+
+
+
+def clear_caches() -> None:
+    """
+    Drops the layers, time series and surfaces loaded by this process, so the next calls read the files again.
+    """
+    for loader in (load_layer, load_hotspot_edges, load_timeseries, load_density):
+        loader.cache_clear()
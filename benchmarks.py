@@ -0,0 +1,205 @@
+import matplotlib
+matplotlib.use('Agg')
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+import geopandas as gpd
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import shapely
+from utils import count_houses, count_hierarchy, plot_ratio_map
+from rendering import build_map
+from density import ratio_surfaces
+
+
+# Sizes of the synthetic city: side of the grid of censal sections, parcels and listings
+SCALES = {
+    'small': {'grid': 10, 'n_parcels': 5_000, 'n_listings': 2_000},
+    'city': {'grid': 33, 'n_parcels': 70_000, 'n_listings': 20_000}, # About the size of Barcelona
+    'large': {'grid': 60, 'n_parcels': 250_000, 'n_listings': 80_000},
+}
+RESULTS_PATH = 'benchmarks.json' # Runs are appended, so regressions show against earlier runs
+TOLERANCE = 0.2 # Slowdown over the baseline reported as a regression
+
+ORIGIN = (2.05, 41.32) # South-west corner of the synthetic city, in EPSG:4326
+EXTENT = 0.15 # Side of the synthetic city, in degrees
+
+
+
+def synthetic_city(grid: int = 10, n_parcels: int = 5_000, n_listings: int = 2_000, seed: int = 0):
+    """
+    Generates an offline, reproducible city with the same columns as the real inputs.
+
+    The censal sections are a `grid` x `grid` lattice of squares, grouped 3 x 3 into barris and
+    9 x 9 into districts. Parcels are small rectangles, a few of them straddling two sections,
+    with random dwelling counts, and listings are random points split into flats and rooms.
+
+    Returns:
+    - dict with the GeoDataFrames 'censal', 'barris', 'districts', 'parcels', 'flats' and 'rooms'.
+    """
+    rng = np.random.default_rng(seed)
+    step = EXTENT / grid
+    i, j = np.meshgrid(np.arange(grid), np.arange(grid), indexing='ij')
+    i, j = i.ravel(), j.ravel()
+    x0, y0 = ORIGIN[0] + i * step, ORIGIN[1] + j * step
+    barri = (i // 3) * ((grid + 2) // 3) + j // 3
+    district = (i // 9) * ((grid + 8) // 9) + j // 9
+    censal = gpd.GeoDataFrame({
+        'DISTRICTE': [f'{d + 1:02d}' for d in district],
+        'BARRI': [f'{b + 1:02d}' for b in barri],
+        'SEC_CENS': [f'{k + 1:03d}' for k in range(len(i))],
+        'NOM': [f'Barri {b + 1}' for b in barri],
+    }, geometry=shapely.box(x0, y0, x0 + step, y0 + step), crs="EPSG:4326")
+
+    barris = censal.dissolve('BARRI', aggfunc='first').reset_index()[['BARRI', 'DISTRICTE', 'NOM', 'geometry']]
+    districts = censal.dissolve('DISTRICTE').reset_index()[['DISTRICTE', 'geometry']]
+    districts['NOM'] = [f'District {d}' for d in districts['DISTRICTE']]
+
+    size = rng.uniform(0.01, 0.06, (n_parcels, 2)) * step
+    px = rng.uniform(ORIGIN[0], ORIGIN[0] + EXTENT, n_parcels)
+    py = rng.uniform(ORIGIN[1], ORIGIN[1] + EXTENT, n_parcels)
+    parcels = gpd.GeoDataFrame({
+        'parcel_id': [f'P{k}' for k in range(n_parcels)],
+        'numberOfDwellings': rng.integers(1, 40, n_parcels).astype('int32'),
+    }, geometry=shapely.box(px, py, px + size[:, 0], py + size[:, 1]), crs="EPSG:4326")
+
+    listings = gpd.GeoDataFrame({
+        'id': np.arange(n_listings, dtype='int64'),
+        'property_type_basic': pd.Categorical(rng.choice(['Flat', 'Room'], n_listings, p=[0.6, 0.4]), categories=['Flat', 'Room']),
+    }, geometry=gpd.points_from_xy(rng.uniform(ORIGIN[0], ORIGIN[0] + EXTENT, n_listings),
+                                   rng.uniform(ORIGIN[1], ORIGIN[1] + EXTENT, n_listings)), crs="EPSG:4326")
+
+    return {
+        'censal': censal,
+        'barris': barris,
+        'districts': districts,
+        'parcels': parcels,
+        'flats': listings[listings['property_type_basic'] == 'Flat'].copy(),
+        'rooms': listings[listings['property_type_basic'] == 'Room'].copy(),
+    }
+
+
+
+def _time(func, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        # The progress prints of the timed functions are left out of the output and of the timings
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+    return {'min': min(times), 'median': statistics.median(times), 'repeat': repeat}
+
+
+
+def run_benchmarks(city: dict, repeat: int = 3) -> dict:
+    """
+    Times the aggregation, hotspot surface, export and rendering paths on a synthetic city.
+
+    Returns:
+    - dict mapping each benchmark to its 'min' and 'median' seconds over `repeat` runs.
+    """
+    censal, barris, districts = city['censal'], city['barris'], city['districts']
+    layers = {
+        'n_parcels': (city['parcels'], 'parcel_id', 'numberOfDwellings'),
+        'n_flats': (city['flats'], 'id', None),
+        'n_rooms': (city['rooms'], 'id', None),
+    }
+    with contextlib.redirect_stdout(io.StringIO()):
+        counted = count_hierarchy(layers, censal, barris, districts, method='point', tie_rule='largest_overlap')
+
+    def export(out_dir):
+        for name, gdf in zip(('censal_sections', 'barris', 'districts'), counted):
+            gdf.to_file(os.path.join(out_dir, f'{name}.geojson'), driver='GeoJSON')
+
+    def plot():
+        fig, ax = plt.subplots(figsize=(10, 10))
+        plot_ratio_map(counted[0][counted[0]['ratio'] > counted[0]['ratio'].median()], counted[0], ax)
+        fig.savefig(io.BytesIO(), format='png', dpi=100)
+        plt.close(fig)
+
+    benchmarks = {
+        'count_houses_intersects': lambda: count_houses(city['parcels'], censal, 'n_parcels', apartments_col='numberOfDwellings', method='intersects'),
+        'count_houses_point': lambda: count_houses(city['parcels'], censal, 'n_parcels', apartments_col='numberOfDwellings',
+                                                   method='point', tie_rule='largest_overlap'),
+        'count_houses_listings': lambda: count_houses(city['flats'], censal, 'n_flats', parcel_id_col='id', method='point'),
+        'aggregation': lambda: count_hierarchy(layers, censal, barris, districts, method='point', tie_rule='largest_overlap'),
+        'density_surface': lambda: ratio_surfaces({'ratio_flats': city['flats'], 'ratio_rooms': city['rooms']}, city['parcels']),
+        'plot_ratio_map': plot,
+        'build_map': lambda: build_map(counted[0], 'ratio').get_root().render(),
+    }
+    results = {}
+    for name, func in benchmarks.items():
+        results[name] = _time(func, repeat)
+        print(f"{name:<26} {results[name]['min']:8.3f} s")
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        results['geojson_export'] = _time(lambda: export(out_dir), repeat)
+    print(f"{'geojson_export':<26} {results['geojson_export']['min']:8.3f} s")
+    return results
+
+
+
+def compare_runs(run: dict, baseline: dict, tolerance: float = TOLERANCE) -> list:
+    """
+    Lists the benchmarks of `run` whose minimum time is more than `tolerance` slower than in `baseline`.
+    """
+    regressions = []
+    for name, result in run['results'].items():
+        if name in baseline['results']:
+            ratio = result['min'] / baseline['results'][name]['min']
+            if ratio > 1 + tolerance:
+                regressions.append(name)
+            print(f"{name:<26} {ratio:6.2f}x {'REGRESSION' if ratio > 1 + tolerance else ''}")
+    return regressions
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times the aggregation and rendering paths on a synthetic city, offline.")
+    parser.add_argument('--scale', choices=list(SCALES), default='small')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=RESULTS_PATH, help="JSON file the run is appended to.")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help="Slowdown over the last run of the same scale reported as a regression.")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    city = synthetic_city(**SCALES[args.scale], seed=args.seed)
+    print(f"Synthetic city '{args.scale}' generated in {time.perf_counter() - start:.2f} s")
+
+    run = {
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'scale': args.scale,
+        **SCALES[args.scale],
+        'seed': args.seed,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': run_benchmarks(city, args.repeat),
+    }
+
+    runs = []
+    if os.path.exists(args.output):
+        with open(args.output) as f:
+            runs = json.load(f)
+    baseline = next((r for r in reversed(runs) if r['scale'] == args.scale), None)
+    regressions = []
+    if baseline is not None:
+        print(f"Against the run of {baseline['date']}:")
+        regressions = compare_runs(run, baseline, args.tolerance)
+    runs.append(run)
+    with open(args.output, 'w') as f:
+        json.dump(runs, f, indent=1)
+    # A non-zero exit status lets CI fail on regressions
+    if regressions:
+        sys.exit(f"{len(regressions)} regression(s): {', '.join(regressions)}")
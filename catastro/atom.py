@@ -1,24 +1,29 @@
 import geopandas as gpd
-import requests
+import pyogrio
 from shapely.geometry import box
 import osmnx as ox
 from osmnx._errors import InsufficientResponseError
 from tobler.util import h3fy
 import pandas as pd
 from tqdm import tqdm
-from .settings import Settings, Headers
+from .settings import Settings
 tqdm.pandas()
 import xml.etree.ElementTree as ET
 import os
-import zipfile
-from io import BytesIO
+from .download import download_file, extract_member
+from .feeds import default_client
+from .gml import read_building_points
+from .instrumentation import instrumented
 
 ##############################################
-def parse_atom(url):
+@instrumented('atom.parse_atom')
+def parse_atom(url, client=None):
     """
     Fetches and parses an Atom feed from the given URL.
     Args:
         url (str): The URL of the Atom feed to fetch and parse.
+        client (FeedClient, optional): Client used to fetch the feed. Defaults to the shared client,
+            which only downloads the feed again when it changed.
     Returns:
         xml.etree.ElementTree.Element: The root element of the parsed Atom feed.
     Raises:
@@ -26,18 +31,117 @@ def parse_atom(url):
         xml.etree.ElementTree.ParseError: If the response content is not valid XML.
     """
    
-    response = requests.get(url)
-    response.raise_for_status()
-    return ET.fromstring(response.content)
+    client = client or default_client()
+    return ET.parse(client.fetch(url)).getroot()
+
+
+##############################################
+@instrumented('atom.find_province_feed')
+def find_province_feed(province_name, client=None):
+    """
+    Finds the Atom feed of a province in the main cadastre feed.
+    Args:
+        province_name (str): Name, or part of the name, of the province.
+        client (FeedClient, optional): Client used to fetch the feed.
+    Returns:
+        tuple: (title, url) of the province feed.
+    Raises:
+        Exception: If no feed, or more than one, matches the name.
+    """
+    client = client or default_client()
+    matches = client.find_entries(Settings.ATOM_URL, province_name, '.xml')
+
+    if len(matches) > 0:
+        if len(matches) == 1:
+            return matches[0]
+        else:
+            print(f"Multiple feeds found for '{province_name}': {len(matches)}")
+            print("Available feeds:")
+            for i, (title, href) in enumerate(matches):
+                print(f"{i+1}: {title}: {href}")
+            raise Exception(f"Multiple feeds found for '{province_name}'. Please specify one.")
+    else:
+        raise Exception(f"Province '{province_name}' not found in main feed.")
+
+
+##############################################
+@instrumented('gml.read_buildings', rows=len)
+def read_buildings(gml_path, use_cache=True, points=False):
+    """
+    Reads the buildings of an INSPIRE GML keeping only what the analysis needs, through a GeoParquet cache.
+
+    The first read converts the GML into a GeoParquet file next to it, holding 'parcel_id',
+    'numberOfDwellings' as an integer and the geometry in EPSG:4326. Later reads load that file
+    as long as it is newer than the GML.
+
+    Args:
+        gml_path (str): Path of the buildings GML.
+        use_cache (bool): If False, the GML is parsed and the cache is neither read nor written.
+        points (bool): If True, the GML is streamed and each building is reduced to a representative
+            point (see catastro.gml), without materializing any footprint.
+    Returns:
+        geopandas.GeoDataFrame: The buildings with columns 'parcel_id', 'numberOfDwellings' and 'geometry'.
+    """
+    cache_path = os.path.splitext(gml_path)[0] + ('.points.parquet' if points else '.parquet')
+    if use_cache and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(gml_path):
+        return gpd.read_parquet(cache_path)
+
+    if points:
+        arrays = read_building_points(gml_path, crs="EPSG:4326")
+        buildings = gpd.GeoDataFrame({
+            'parcel_id': arrays['parcel_id'],
+            'numberOfDwellings': arrays['numberOfDwellings'],
+        }, geometry=gpd.points_from_xy(arrays['x'], arrays['y']), crs=arrays['crs'])
+        if use_cache:
+            buildings.to_parquet(cache_path, index=False)
+        return buildings
+
+    # Column projection: only parse the identifier and the dwellings count
+    fields = set(pyogrio.read_info(gml_path)['fields'])
+    id_col = next((col for col in ('localId', 'gml_id') if col in fields), None)
+    columns = [col for col in (id_col, 'numberOfDwellings') if col is not None and col in fields]
+    buildings = gpd.read_file(gml_path, columns=columns)
+    # Feeds without the field count no dwellings rather than failing
+    dwellings = buildings['numberOfDwellings'] if 'numberOfDwellings' in buildings.columns else pd.Series(0, index=buildings.index)
+
+    buildings = gpd.GeoDataFrame({
+        'parcel_id': buildings[id_col] if id_col else buildings.index.astype(str),
+        'numberOfDwellings': pd.to_numeric(dwellings, errors='coerce').fillna(0).astype('int32'),
+    }, geometry=buildings.geometry.to_crs("EPSG:4326"))
+
+    if use_cache:
+        buildings.to_parquet(cache_path, index=False)
+    return buildings
+
+
+##############################################
+def download_gml(zip_url, output_dir="inspire_data", cache_dir=Settings.CACHE_DIR, session=None, use_cache=True, points=False):
+    """
+    Downloads (through the cache) the archive of a municipality and reads its buildings GML.
+    Args:
+        zip_url (str): URL of the municipality ZIP archive.
+        output_dir (str): Directory where the GML and its GeoParquet cache are stored.
+        cache_dir (str): Directory holding the download cache.
+        session (requests.Session, optional): Session used for the download.
+        use_cache (bool): Whether to use the GeoParquet cache of the parsed buildings.
+        points (bool): Whether to reduce each building to a representative point while streaming the GML.
+    Returns:
+        geopandas.GeoDataFrame: The buildings of the municipality, see `read_buildings`.
+    """
+    zip_path = download_file(zip_url, cache_dir=cache_dir, session=session)
+    municipality_folder = os.path.join(output_dir, os.path.basename(zip_url))
+    gml_path = extract_member(zip_path, municipality_folder, suffix='.gml', prefer='building.gml')
+    return read_buildings(gml_path, use_cache=use_cache, points=points)
 
 
 #############################################
 #############################################
 
 class ATOM_Query():
-    def __init__(self, province_name, municipality_name):
+    def __init__(self, province_name, municipality_name, client=None):
         self._province_name = province_name
         self._municipality_name = municipality_name
+        self._client = client or default_client()
         print(f"Collecting features for municipalities containing '{self.municipality_name}' in '{self.province_name}'")
         self._province_title, self._province_feed_url = self.find_province_feed()
         self._municipality_title, self._municipality_zip_url = self.find_municipality_zip_url()
@@ -52,6 +156,10 @@ class ATOM_Query():
     def municipality_name(self):
         return self._municipality_name
 
+    @property
+    def client(self):
+        return self._client
+
     @property
     def province_title(self):
         return self._province_title
@@ -71,57 +179,22 @@ class ATOM_Query():
     ##################################################
 
     def find_province_feed(self):
-        root = parse_atom(Settings.ATOM_URL)
-        hrefs = []
-        titles = []
-        for entry in root.findall('atom:entry',Headers.ATOM_NS):
-            title = entry.find('atom:title', Headers.ATOM_NS).text.strip()
-            if self.province_name.lower() in title.lower():
-                link = entry.find('atom:link', Headers.ATOM_NS)
-                href = link.attrib.get('href', '')
-                rel = link.attrib.get('rel', '')
-                if rel == 'enclosure' and href.endswith('.xml'):
-                    hrefs.append(href)
-                    titles.append(title)
-
-        if len(hrefs) > 0:
-            if len(hrefs) == 1:
-                return titles[0], hrefs[0]
-            else:
-                print(f"Multiple feeds found for '{self.province_name}': {len(hrefs)}")
-                print("Available feeds:")
-                for i, href in enumerate(hrefs):
-                    print(f"{i+1}: {title}: {href}")
-                raise Exception(f"Multiple feeds found for '{self.province_name}'. Please specify one.")
-        else:
-            raise Exception(f"Province '{self.province_name}' not found in main feed.")
+        return find_province_feed(self.province_name, client=self.client)
 
     ##################################################
 
+    @instrumented('atom.find_municipality_zip_url')
     def find_municipality_zip_url(self):
-        root = parse_atom(self.province_feed_url)
-        hrefs =[]
-        titles =[]
-        for entry in root.findall('atom:entry', Headers.ATOM_NS):
-            title_elem = entry.find('atom:title', Headers.ATOM_NS)
-            if title_elem is not None:
-                title = title_elem.text.strip()
-                if self.municipality_name.lower() in title.lower():
-                    for link in entry.findall('atom:link', Headers.ATOM_NS):
-                        href = link.attrib.get('href', '')
-                        rel = link.attrib.get('rel', '')
-                        if href.endswith('.zip') and rel == 'enclosure':
-                            hrefs.append(href)
-                            titles.append(title)
-
-        if len(hrefs) > 0:
-            if len(hrefs) == 1:
-                return titles[0], hrefs[0]
+        matches = self.client.find_entries(self.province_feed_url, self.municipality_name, '.zip')
+
+        if len(matches) > 0:
+            if len(matches) == 1:
+                return matches[0]
             else:
-                print(f"Multiple feeds found for '{self.municipality_name}': {len(hrefs)}")
+                print(f"Multiple feeds found for '{self.municipality_name}': {len(matches)}")
                 print("Please specify one.")
                 print("Available feeds:")
-                for i, href in enumerate(hrefs):
+                for i, (title, href) in enumerate(matches):
                     print(f"{i+1}: {title}: {href}")
                 return None, None
         else:
@@ -129,16 +202,6 @@ class ATOM_Query():
 
     ##################################################  
 
-    def download_gml(self, output_dir="inspire_data"):
-        response = requests.get(self.municipality_zip_url)
-        response.raise_for_status()
-        municipality_folder = os.path.join(output_dir, os.path.basename(self.municipality_zip_url))
-        os.makedirs(municipality_folder, exist_ok=True)
-
-        with zipfile.ZipFile(BytesIO(response.content)) as z:
-            z.extractall(municipality_folder)
-            gml_files = [f for f in z.namelist() if f.endswith('.gml')]
-            if not gml_files:
-                raise Exception("No GML file found in ZIP.")
-            gml_path = os.path.join(municipality_folder, gml_files[0])
-            return gpd.read_file(gml_path)
\ No newline at end of file
+    def download_gml(self, output_dir="inspire_data", cache_dir=Settings.CACHE_DIR, session=None, use_cache=True, points=False):
+        return download_gml(self.municipality_zip_url, output_dir=output_dir, cache_dir=cache_dir,
+                            session=session or self.client.session, use_cache=use_cache, points=points)
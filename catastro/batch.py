@@ -0,0 +1,108 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import geopandas as gpd
+import pandas as pd
+from tqdm import tqdm
+from .settings import Settings
+from .feeds import default_client, entry_name
+from .atom import find_province_feed, download_gml
+
+##############################################
+def resolve_municipalities(province_feed_url, municipality_names=None, client=None):
+    """
+    Resolves the ZIP URLs of several municipalities from a single parse of the province feed.
+
+    A name is resolved to the entry whose name equals it, or to the only entry containing it.
+
+    Args:
+        province_feed_url (str): URL of the province feed.
+        municipality_names (list of str, optional): Municipalities to resolve. If None, every
+            municipality of the province is returned.
+        client (FeedClient, optional): Client used to fetch the feed.
+    Returns:
+        tuple: (resolved, failures). `resolved` is a list of (name, title, url) tuples and
+        `failures` a dict mapping unresolved names to the reason.
+    """
+    client = client or default_client()
+    entries = [(title, href)
+               for title, links in client.iter_entries(province_feed_url)
+               for rel, href in links
+               if rel == 'enclosure' and href.endswith('.zip')]
+
+    if municipality_names is None:
+        return [(entry_name(title), title, href) for title, href in entries], {}
+
+    resolved = []
+    failures = {}
+    for name in municipality_names:
+        exact = [(title, href) for title, href in entries if entry_name(title).lower() == name.lower()]
+        matches = exact or [(title, href) for title, href in entries if name.lower() in title.lower()]
+        if len(matches) == 1:
+            resolved.append((name, *matches[0]))
+        elif len(matches) == 0:
+            failures[name] = "not found in province feed"
+        else:
+            failures[name] = "ambiguous: " + ", ".join(title for title, _ in matches)
+    return resolved, failures
+
+
+##############################################
+def _load_municipality(zip_url, output_dir, cache_dir, points):
+    start = time.perf_counter()
+    parcels = download_gml(zip_url, output_dir=output_dir, cache_dir=cache_dir, points=points)
+    return parcels, time.perf_counter() - start
+
+
+def fetch_municipalities(province_name, municipality_names=None, max_workers=4, use_processes=False,
+                         output_dir="inspire_data", cache_dir=Settings.CACHE_DIR, client=None, points=False):
+    """
+    Downloads and parses the buildings of several municipalities, or of a whole province, concurrently.
+
+    Args:
+        province_name (str): Name of the province, as in ATOM_Query.
+        municipality_names (list of str, optional): Municipalities to fetch. If None, the whole province is fetched.
+        max_workers (int): Size of the worker pool.
+        use_processes (bool): If True, GMLs are parsed in a process pool instead of a thread pool.
+        output_dir (str): Directory where the GMLs are extracted.
+        cache_dir (str): Directory holding the download cache.
+        client (FeedClient, optional): Client used to fetch the feeds.
+        points (bool): Whether to reduce each building to a representative point, see `read_buildings`.
+    Returns:
+        tuple: (parcels, report). `parcels` is a GeoDataFrame with the buildings of every
+        municipality fetched and a 'municipality' column. `report` is a DataFrame with one row
+        per requested municipality: 'municipality', 'title', 'url', 'status', 'n_parcels',
+        'seconds' and 'error'.
+    """
+    client = client or default_client()
+    _, province_feed_url = find_province_feed(province_name, client=client)
+    resolved, failures = resolve_municipalities(province_feed_url, municipality_names, client=client)
+    print(f"Fetching {len(resolved)} municipalities in '{province_name}' ({len(failures)} unresolved)")
+
+    rows = [{'municipality': name, 'title': None, 'url': None, 'status': 'failed',
+             'n_parcels': 0, 'seconds': 0.0, 'error': reason} for name, reason in failures.items()]
+    frames = []
+
+    Executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with Executor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_load_municipality, url, output_dir, cache_dir, points): (name, title, url)
+                   for name, title, url in resolved}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            name, title, url = futures[future]
+            row = {'municipality': name, 'title': title, 'url': url}
+            try:
+                parcels, seconds = future.result()
+            except Exception as e:
+                row.update(status='failed', n_parcels=0, seconds=0.0, error=str(e))
+            else:
+                parcels['municipality'] = name
+                frames.append(parcels)
+                row.update(status='ok', n_parcels=len(parcels), seconds=seconds, error=None)
+            rows.append(row)
+
+    report = pd.DataFrame(rows, columns=['municipality', 'title', 'url', 'status', 'n_parcels', 'seconds', 'error'])
+    if not frames:
+        return gpd.GeoDataFrame(columns=['municipality', 'geometry'], geometry='geometry'), report
+
+    parcels = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), geometry='geometry', crs=frames[0].crs)
+    print(f"{(report['status'] == 'ok').sum()} municipalities fetched, {(report['status'] == 'failed').sum()} failed")
+    return parcels, report
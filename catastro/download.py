@@ -0,0 +1,214 @@
+import hashlib
+import json
+import os
+import shutil
+import zipfile
+import requests
+from .settings import Settings
+from .feeds import default_client
+from .instrumentation import instrumented, add_bytes
+
+##############################################
+def _url_key(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def _file_sha256(path, chunk_size=Settings.CHUNK_SIZE):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_json(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_json(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _discard(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _expected_size(response):
+    # Total size of the remote file, if the response tells it for the bytes as written to disk
+    if response.status_code == 206:
+        total = response.headers.get('Content-Range', '').rpartition('/')[2]
+        return int(total) if total.isdigit() else None
+    if response.headers.get('Content-Encoding') or not response.headers.get('Content-Length', '').isdigit():
+        return None
+    return int(response.headers['Content-Length'])
+
+
+##############################################
+@instrumented('atom.download_file')
+def download_file(url, cache_dir=Settings.CACHE_DIR, session=None, revalidate=True, chunk_size=Settings.CHUNK_SIZE, timeout=Settings.TIMEOUT):
+    """
+    Downloads a file into a content-addressed cache, streaming it to disk in chunks.
+
+    The cache keeps one index entry per URL (checksum, ETag and Last-Modified) and stores
+    the payload under its SHA-256, so an unchanged file is never downloaded twice.
+    Interrupted downloads are resumed with an HTTP Range request. A partial file that cannot be
+    resumed (416 response) or does not end up with the size of the remote file is discarded and
+    downloaded again from the start.
+
+    Args:
+        url (str): The URL of the file to download.
+        cache_dir (str): Directory holding the cache.
+        session (requests.Session, optional): Session used for the requests. Defaults to the pooled
+            session of the shared FeedClient.
+        revalidate (bool): If True, a cached file is revalidated with a conditional request.
+            If False, a cached file is returned without touching the network.
+        chunk_size (int): Size in bytes of the chunks written to disk.
+        timeout (float): Timeout in seconds of every request.
+    Returns:
+        str: Path of the cached file.
+    Raises:
+        requests.HTTPError: If the HTTP request to the URL fails.
+        Exception: If the file cannot be downloaded with the size announced by the server.
+    """
+    session = session or default_client().session
+    key = _url_key(url)
+    index_dir = os.path.join(cache_dir, 'index')
+    objects_dir = os.path.join(cache_dir, 'objects')
+    partial_dir = os.path.join(cache_dir, 'partial')
+    for folder in (index_dir, objects_dir, partial_dir):
+        os.makedirs(folder, exist_ok=True)
+
+    index_path = os.path.join(index_dir, key + '.json')
+    meta = _read_json(index_path)
+    extension = os.path.splitext(url.split('?')[0])[1]
+    cached_path = os.path.join(objects_dir, meta['sha256'] + extension) if meta else None
+
+    headers = {}
+    if cached_path and os.path.exists(cached_path):
+        if not revalidate:
+            return cached_path
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    # Resume a previous partial download, as long as the file did not change meanwhile
+    partial_path = os.path.join(partial_dir, key + extension)
+    partial_meta_path = partial_path + '.json'
+    for _ in range(2):
+        partial_meta = _read_json(partial_meta_path)
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        request_headers = dict(headers)
+        if offset > 0 and 'If-None-Match' not in headers:
+            request_headers['Range'] = f'bytes={offset}-'
+            validator = partial_meta.get('etag') or partial_meta.get('last_modified')
+            if validator:
+                request_headers['If-Range'] = validator
+
+        try:
+            response = session.get(url, headers=request_headers, stream=True, timeout=timeout)
+        except requests.ConnectionError:
+            if cached_path and os.path.exists(cached_path):
+                print(f"Could not reach '{url}', using cached copy.")
+                return cached_path
+            raise
+
+        with response:
+            if response.status_code == 304:
+                return cached_path
+            if response.status_code == 416:
+                # The partial file is already complete or longer than the remote file, so it cannot be resumed
+                print(f"Cannot resume '{url}' at {offset} bytes, downloading it again")
+                _discard(partial_path, partial_meta_path)
+                continue
+            response.raise_for_status()
+
+            if response.status_code == 206:
+                mode = 'ab'
+                print(f"Resuming download of '{url}' at {offset} bytes")
+            else:
+                mode = 'wb'
+            _write_json(partial_meta_path, {'url': url,
+                                            'etag': response.headers.get('ETag'),
+                                            'last_modified': response.headers.get('Last-Modified')})
+
+            with open(partial_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    add_bytes(len(chunk))
+
+        expected = _expected_size(response)
+        if expected is None or os.path.getsize(partial_path) == expected:
+            break
+        print(f"Downloaded {os.path.getsize(partial_path)} bytes of '{url}' instead of {expected}, downloading it again")
+        _discard(partial_path, partial_meta_path)
+    else:
+        raise Exception(f"Could not download '{url}' completely.")
+
+    sha256 = _file_sha256(partial_path, chunk_size)
+    object_path = os.path.join(objects_dir, sha256 + extension)
+    if os.path.exists(object_path):
+        os.remove(partial_path)
+    else:
+        os.replace(partial_path, object_path)
+    os.remove(partial_meta_path)
+
+    _write_json(index_path, {'url': url,
+                             'sha256': sha256,
+                             'size': os.path.getsize(object_path),
+                             'etag': response.headers.get('ETag'),
+                             'last_modified': response.headers.get('Last-Modified')})
+    return object_path
+
+
+##############################################
+def extract_member(zip_path, output_dir, suffix='.gml', prefer=None):
+    """
+    Extracts a single member of a ZIP archive, skipping it if it is already extracted.
+
+    Args:
+        zip_path (str): Path of the ZIP archive.
+        output_dir (str): Directory to extract the member into.
+        suffix (str): Only members whose name ends with this suffix are considered.
+        prefer (str, optional): Among those, pick the first one ending with this suffix if any.
+    Returns:
+        str: Path of the extracted member.
+    Raises:
+        Exception: If no member of the archive ends with `suffix`, or the member would be extracted
+            outside `output_dir`.
+    """
+    with zipfile.ZipFile(zip_path) as z:
+        members = [info for info in z.infolist() if info.filename.endswith(suffix)]
+        if not members:
+            raise Exception(f"No {suffix} file found in ZIP.")
+        preferred = [info for info in members if prefer and info.filename.endswith(prefer)]
+        member = (preferred or members)[0]
+
+        # Member names come from the archive, so they must not escape the output directory
+        out_path = os.path.join(output_dir, member.filename)
+        root = os.path.realpath(output_dir)
+        if os.path.commonpath([root, os.path.realpath(out_path)]) != root:
+            raise Exception(f"Refusing to extract '{member.filename}' outside '{output_dir}'.")
+
+        # The archive is content-addressed, so its name identifies the extracted version
+        source_path = out_path + '.source'
+        source = os.path.basename(zip_path)
+        if os.path.exists(out_path) and os.path.exists(source_path):
+            with open(source_path) as f:
+                if f.read() == source:
+                    return out_path
+
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        with z.open(member) as src, open(out_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        with open(source_path, 'w') as f:
+            f.write(source)
+        return out_path
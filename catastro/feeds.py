@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+import re
+import time
+import xml.etree.ElementTree as ET
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .settings import Settings, Headers
+from .instrumentation import instrumented, add_bytes
+
+ATOM = '{' + Headers.ATOM_NS['atom'] + '}'
+
+##############################################
+def entry_name(title):
+    """
+    Strips the leading code of an Atom entry title, e.g. '08900-BARCELONA' -> 'BARCELONA'.
+    """
+    return re.sub(r'^.*\d[\s\-]*', '', title).strip()
+
+
+#############################################
+#############################################
+
+class FeedClient():
+    """
+    Fetches Atom feeds through a pooled session and keeps them in an on-disk cache
+    validated with ETag/Last-Modified.
+
+    Args:
+        cache_dir (str): Directory holding the cached feeds.
+        max_age (float): Seconds during which a cached feed is used without revalidation.
+        pool_size (int): Maximum number of pooled connections per host.
+        timeout (float): Timeout in seconds of every request.
+    """
+    def __init__(self, cache_dir=Settings.FEED_CACHE_DIR, max_age=Settings.FEED_MAX_AGE, pool_size=Settings.POOL_SIZE, timeout=Settings.TIMEOUT):
+        self._cache_dir = cache_dir
+        self._max_age = max_age
+        self._timeout = timeout
+        self._session = requests.Session()
+        retries = Retry(total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    ##################################################
+
+    @property
+    def session(self):
+        return self._session
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    ##################################################
+
+    @instrumented('atom.fetch_feed')
+    def fetch(self, url):
+        """
+        Returns the path of the cached copy of a feed, downloading it only if it changed.
+        Raises:
+            requests.HTTPError: If the HTTP request to the URL fails.
+        """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        path = os.path.join(self.cache_dir, key + '.xml')
+        meta_path = path + '.json'
+        meta = {}
+        if os.path.exists(path) and os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if time.time() - meta.get('checked', 0) < self._max_age:
+                return path
+
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            response = self.session.get(url, headers=headers, stream=True, timeout=self._timeout)
+        except requests.ConnectionError:
+            if meta:
+                print(f"Could not reach '{url}', using cached feed.")
+                return path
+            raise
+
+        with response:
+            if response.status_code != 304:
+                response.raise_for_status()
+                with open(path + '.tmp', 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=Settings.CHUNK_SIZE):
+                        f.write(chunk)
+                        add_bytes(len(chunk))
+                os.replace(path + '.tmp', path)
+                meta = {'url': url,
+                        'etag': response.headers.get('ETag'),
+                        'last_modified': response.headers.get('Last-Modified')}
+
+        meta['checked'] = time.time()
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        return path
+
+    ##################################################
+
+    def iter_entries(self, url):
+        """
+        Streams the entries of a feed with iterparse, yielding (title, links) where links
+        is a list of (rel, href) tuples. Parsed entries are released as soon as they are yielded.
+        """
+        context = ET.iterparse(self.fetch(url), events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'end' and elem.tag == ATOM + 'entry':
+                title = elem.findtext(ATOM + 'title')
+                if title is not None:
+                    links = [(link.attrib.get('rel', ''), link.attrib.get('href', '')) for link in elem.findall(ATOM + 'link')]
+                    yield title.strip(), links
+                root.clear()
+
+    ##################################################
+
+    def find_entries(self, url, name, extension, rel='enclosure'):
+        """
+        Finds the links of the entries whose title contains `name`.
+
+        An entry whose name (the title without its leading code) equals `name` is an exact
+        match: it is returned alone and the rest of the feed is not parsed.
+
+        Returns:
+            list of (title, href) tuples.
+        """
+        matches = []
+        for title, links in self.iter_entries(url):
+            if name.lower() not in title.lower():
+                continue
+            hrefs = [href for link_rel, href in links if link_rel == rel and href.endswith(extension)]
+            if not hrefs:
+                continue
+            if entry_name(title).lower() == name.lower():
+                return [(title, hrefs[0])]
+            matches.extend((title, href) for href in hrefs)
+        return matches
+
+
+##############################################
+_default_client = None
+
+def default_client():
+    """
+    Returns the process-wide FeedClient, creating it on first use.
+    """
+    global _default_client
+    if _default_client is None:
+        _default_client = FeedClient()
+    return _default_client
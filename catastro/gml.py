@@ -0,0 +1,121 @@
+from array import array
+import re
+import xml.etree.ElementTree as ET
+import numpy as np
+import pyproj
+from .instrumentation import instrumented
+
+##############################################
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _srs_to_crs(srs_name):
+    """
+    Turns a GML srsName ('urn:ogc:def:crs:EPSG::25831', 'http://www.opengis.net/def/crs/EPSG/0/25831', 'EPSG:25831') into 'EPSG:<code>'.
+    """
+    match = re.search(r'EPSG\D*(?:\d+\D+)?(\d+)$', srs_name or '')
+    return f"EPSG:{match.group(1)}" if match else None
+
+
+def _ring_centroid(coords):
+    """
+    Returns (area, x, y) of a closed ring given as an (n, 2) array, using the shoelace formula.
+    Degenerate rings fall back to the mean of their vertices with zero area.
+    """
+    x, y = coords[:, 0], coords[:, 1]
+    cross = x[:-1] * y[1:] - x[1:] * y[:-1]
+    area = cross.sum() / 2
+    if area == 0:
+        return 0.0, x.mean(), y.mean()
+    cx = ((x[:-1] + x[1:]) * cross).sum() / (6 * area)
+    cy = ((y[:-1] + y[1:]) * cross).sum() / (6 * area)
+    return abs(area), cx, cy
+
+
+##############################################
+def iter_building_points(gml_path, feature='Building'):
+    """
+    Streams the features of an INSPIRE buildings GML with iterparse, without building any geometry object.
+
+    The representative point of every feature is the area-weighted centroid of the exterior rings of
+    its footprint. Elements are released as soon as each feature is read, so memory use does not
+    grow with the size of the file.
+
+    Args:
+        gml_path (str): Path of the GML file.
+        feature (str): Local name of the feature elements.
+    Yields:
+        tuple: (local_id, number_of_dwellings, x, y, crs) per feature, in the CRS of the file.
+    """
+    context = ET.iterparse(gml_path, events=('start', 'end'))
+    _, root = next(context)
+    srs_name = None
+    for event, elem in context:
+        if event == 'start':
+            if srs_name is None and 'srsName' in elem.attrib:
+                srs_name = elem.attrib['srsName']
+            continue
+        if _local(elem.tag) != feature:
+            continue
+
+        local_id = elem.get('{http://www.opengis.net/gml/3.2}id') or elem.get('{http://www.opengis.net/gml}id')
+        dwellings = 0
+        rings = []
+        for child in elem.iter():
+            name = _local(child.tag)
+            if name == 'localId' and child.text:
+                local_id = child.text.strip()
+            elif name == 'numberOfDwellings' and child.text:
+                dwellings = int(float(child.text))
+            elif name == 'exterior':
+                pos_list = next((e for e in child.iter() if _local(e.tag) == 'posList'), None)
+                if pos_list is not None and pos_list.text:
+                    dim = int(pos_list.get('srsDimension', 2))
+                    rings.append(_ring_centroid(np.array(pos_list.text.split(), dtype=float).reshape(-1, dim)[:, :2]))
+
+        if rings:
+            areas, cxs, cys = np.array(rings).T
+            weights = areas if areas.sum() > 0 else None
+            yield local_id, dwellings, np.average(cxs, weights=weights), np.average(cys, weights=weights), _srs_to_crs(srs_name)
+        root.clear()
+
+
+##############################################
+@instrumented('gml.read_building_points', rows=lambda arrays: len(arrays['parcel_id']))
+def read_building_points(gml_path, crs="EPSG:4326", feature='Building'):
+    """
+    Reads an INSPIRE buildings GML into compact arrays of identifiers, dwellings and representative points.
+
+    Args:
+        gml_path (str): Path of the GML file.
+        crs (str): CRS of the returned coordinates. If None, coordinates stay in the CRS of the file.
+        feature (str): Local name of the feature elements.
+    Returns:
+        dict: 'parcel_id' (object array), 'numberOfDwellings' (int32 array), 'x' and 'y' (float64 arrays)
+        and 'crs' (str).
+    """
+    ids = []
+    dwellings = array('i')
+    xs = array('d')
+    ys = array('d')
+    source_crs = None
+    for local_id, n, x, y, point_crs in iter_building_points(gml_path, feature=feature):
+        ids.append(local_id)
+        dwellings.append(n)
+        xs.append(x)
+        ys.append(y)
+        source_crs = source_crs or point_crs
+
+    x = np.frombuffer(xs, dtype=np.float64)
+    y = np.frombuffer(ys, dtype=np.float64)
+    if crs is not None and source_crs is not None and pyproj.CRS(source_crs) != pyproj.CRS(crs):
+        x, y = pyproj.Transformer.from_crs(source_crs, crs, always_xy=True).transform(x, y)
+    else:
+        crs = source_crs
+
+    return {'parcel_id': np.array(ids, dtype=object),
+            'numberOfDwellings': np.frombuffer(dwellings, dtype=np.int32),
+            'x': np.asarray(x),
+            'y': np.asarray(y),
+            'crs': crs}
@@ -7,6 +7,16 @@ class Settings:
     CRS = 'EPSG:25830' #Geographic CRS to demand results
     H3_ZOOM = 9 #H3_Zoom for the wfs grid
     ATOM_URL = "https://www.catastro.hacienda.gob.es/INSPIRE/buildings/ES.SDGC.bu.atom.xml"
+    CACHE_DIR = "inspire_data/cache" # Content-addressed cache of downloaded archives
+    CHUNK_SIZE = 1 << 20 # Bytes per chunk when streaming downloads to disk
+    TIMEOUT = 60 # Seconds before a request to the cadastre gives up
+    FEED_CACHE_DIR = "inspire_data/feeds" # On-disk cache of the Atom feeds
+    FEED_MAX_AGE = 3600 # Seconds during which a cached feed is trusted without revalidation
+    POOL_SIZE = 8 # Pooled connections per host
+    WFS_TYPE_NAME = 'CP:CadastralParcel' # Feature type of the parcels in the WFS
+    WFS_CACHE_DIR = "inspire_data/wfs" # On-disk cache of the WFS tiles
+    WFS_TILE_SIZE = 500 # Metres per side of the WFS tiles
+    WFS_WORKERS = 4 # Concurrent WFS requests
 
 class Headers:
     ATOM_NS = {'atom': 'http://www.w3.org/2005/Atom'}
\ No newline at end of file
@@ -0,0 +1,271 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import geopandas as gpd
+import h3
+import numpy as np
+import pandas as pd
+import pyproj
+import requests
+import shapely
+from requests.adapters import HTTPAdapter
+from shapely.ops import transform
+from tqdm import tqdm
+from urllib3.util.retry import Retry
+from .settings import Settings
+from .instrumentation import instrumented, add_bytes
+
+# Identifier columns of the WFS features, by preference, used to drop the copies fetched by neighbouring tiles
+ID_COLUMNS = ('localId', 'nationalCadastralReference', 'gml_id')
+# Lowercase fragments of the exception reports refusing a request for holding too many features
+TOO_MANY_FEATURES = ('resulttoolarge', 'too many', 'count exceeded', 'exceeds', 'excede', 'máximo', 'maximo')
+
+
+class TooManyFeatures(Exception):
+    """
+    The WFS refused a tile because it holds more features than a request can return.
+    """
+
+##############################################
+def bbox_tiles(bounds, tile_size=Settings.WFS_TILE_SIZE):
+    """
+    Splits a bounding box into a grid of square tiles.
+
+    Args:
+        bounds (tuple): (minx, miny, maxx, maxy) in the projected CRS of the WFS requests.
+        tile_size (float): Side of the tiles, in units of the CRS (metres).
+    Returns:
+        list of (minx, miny, maxx, maxy) tuples.
+    """
+    minx, miny, maxx, maxy = bounds
+    xs = np.append(np.arange(minx, maxx, tile_size), maxx)
+    ys = np.append(np.arange(miny, maxy, tile_size), maxy)
+    return [(float(x0), float(y0), float(x1), float(y1))
+            for x0, x1 in zip(xs[:-1], xs[1:]) if x1 > x0
+            for y0, y1 in zip(ys[:-1], ys[1:]) if y1 > y0]
+
+
+##############################################
+def h3_tiles(area, resolution=Settings.H3_ZOOM, crs=Settings.CRS):
+    """
+    Covers an area with H3 cells and returns the bounding box of each cell.
+
+    Args:
+        area (shapely.Geometry): Polygon in EPSG:4326.
+        resolution (int): H3 resolution of the cells.
+        crs (str): Projected CRS of the returned boxes.
+    Returns:
+        list of (minx, miny, maxx, maxy) tuples, one per cell overlapping the area.
+    """
+    cells = h3.h3shape_to_cells_experimental(h3.geo_to_h3shape(area), resolution, contain='overlap')
+    to_crs = pyproj.Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+    tiles = []
+    for cell in sorted(cells):
+        lat, lng = np.array(h3.cell_to_boundary(cell)).T
+        x, y = to_crs.transform(lng, lat)
+        tiles.append((float(x.min()), float(y.min()), float(x.max()), float(y.max())))
+    return tiles
+
+
+##############################################
+def _split(tile):
+    minx, miny, maxx, maxy = tile
+    midx, midy = (minx + maxx) / 2, (miny + maxy) / 2
+    return [(minx, miny, midx, midy), (midx, miny, maxx, midy), (minx, midy, midx, maxy), (midx, midy, maxx, maxy)]
+
+
+def _read_tile(path):
+    with open(path, 'rb') as f:
+        head = f.read(1 << 16)
+    if b'member' not in head and b'featureMember' not in head:
+        return None
+    return gpd.read_file(path)
+
+
+#############################################
+#############################################
+
+class WFSClient():
+    """
+    Fetches cadastral parcels from the WFS endpoint tile by tile, concurrently and through an on-disk cache.
+
+    Each tile is one GetFeature request by bounding box, stored under the hash of its parameters,
+    so areas that overlap earlier requests only download their new tiles. Tiles the server refuses
+    for holding too many features are split in four, up to `max_splits` times; any other exception
+    report is raised at once.
+
+    Args:
+        url (str): WFS endpoint.
+        type_name (str): Feature type requested.
+        crs (str): Projected CRS of the requests and tiles.
+        cache_dir (str): Directory holding the cached tiles.
+        max_workers (int): Maximum number of concurrent requests.
+        retries (int): Retries of a request failing with a connection error or a 5xx status.
+        timeout (float): Timeout in seconds of every request.
+        max_splits (int): Times a refused tile is split before giving up.
+    """
+    def __init__(self, url=Settings.WFS_URL, type_name=Settings.WFS_TYPE_NAME, crs=Settings.CRS, cache_dir=Settings.WFS_CACHE_DIR,
+                 max_workers=Settings.WFS_WORKERS, retries=3, timeout=Settings.TIMEOUT, max_splits=2):
+        self._url = url
+        self._type_name = type_name
+        self._crs = crs
+        self._cache_dir = cache_dir
+        self._max_workers = max_workers
+        self._timeout = timeout
+        self._max_splits = max_splits
+        self._session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=retry)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    ##################################################
+
+    @property
+    def url(self):
+        return self._url
+
+    @property
+    def crs(self):
+        return self._crs
+
+    @property
+    def session(self):
+        return self._session
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    ##################################################
+
+    def tile_params(self, tile):
+        minx, miny, maxx, maxy = tile
+        return {
+            'service': 'WFS',
+            'version': '2.0.0',
+            'request': 'GetFeature',
+            'typeNames': self._type_name,
+            'srsName': self.crs,
+            'bbox': f"{minx:.2f},{miny:.2f},{maxx:.2f},{maxy:.2f},{self.crs}",
+        }
+
+    def tile_path(self, tile):
+        params = self.tile_params(tile)
+        key = hashlib.sha1((self.url + '?' + '&'.join(f"{k}={v}" for k, v in sorted(params.items()))).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.gml')
+
+    ##################################################
+
+    @instrumented('wfs.fetch_tile')
+    def fetch_tile(self, tile, refresh=False):
+        """
+        Returns the path of the cached GML of a tile, requesting it only if it is not cached.
+        Raises:
+            requests.HTTPError: If the request fails after the retries.
+            TooManyFeatures: If the server refuses the tile for holding too many features.
+            Exception: If the server answers with any other exception report.
+        """
+        path = self.tile_path(tile)
+        if os.path.exists(path) and not refresh:
+            return path
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        response = self.session.get(self.url, params=self.tile_params(tile), timeout=self._timeout)
+        response.raise_for_status()
+        add_bytes(len(response.content))
+        if b'ExceptionReport' in response.content[:2048]:
+            if any(fragment in response.text.lower() for fragment in TOO_MANY_FEATURES):
+                raise TooManyFeatures(f"WFS refused the tile {tile} for holding too many features: {response.text[:500]}")
+            raise Exception(f"WFS refused the tile {tile}: {response.text[:500]}")
+
+        with open(path + '.tmp', 'wb') as f:
+            f.write(response.content)
+        os.replace(path + '.tmp', path)
+        return path
+
+    def _load_tile(self, tile, refresh, splits=0):
+        try:
+            path = self.fetch_tile(tile, refresh=refresh)
+        except TooManyFeatures:
+            if splits >= self._max_splits:
+                raise
+            frames = [self._load_tile(child, refresh, splits + 1) for child in _split(tile)]
+            frames = [frame for frame in frames if frame is not None]
+            return pd.concat(frames, ignore_index=True) if frames else None
+        return _read_tile(path)
+
+    ##################################################
+
+    @instrumented('wfs.fetch', rows=len)
+    def fetch(self, area, tiling='bbox', tile_size=Settings.WFS_TILE_SIZE, resolution=Settings.H3_ZOOM, refresh=False):
+        """
+        Fetches the parcels intersecting an area.
+
+        Args:
+            area (shapely.Geometry or tuple): Polygon, or (minx, miny, maxx, maxy) box, in EPSG:4326.
+            tiling (str): 'bbox' splits the bounds of the area into square tiles of `tile_size`
+                metres; 'h3' requests the bounding box of every H3 cell covering the area.
+            tile_size (float): Side of the 'bbox' tiles, in metres.
+            resolution (int): Resolution of the 'h3' cells.
+            refresh (bool): Request the tiles again even if they are cached.
+        Returns:
+            geopandas.GeoDataFrame: The parcels in EPSG:4326, once each, with a 'parcel_id' column.
+        Raises:
+            Exception: If `tiling` is unknown or a tile cannot be fetched.
+        """
+        if isinstance(area, tuple):
+            area = shapely.box(*area)
+        to_crs = pyproj.Transformer.from_crs("EPSG:4326", self.crs, always_xy=True).transform
+        if tiling == 'bbox':
+            projected = transform(to_crs, area)
+            tiles = [tile for tile in bbox_tiles(projected.bounds, tile_size) if projected.intersects(shapely.box(*tile))]
+        elif tiling == 'h3':
+            tiles = h3_tiles(area, resolution, self.crs)
+        else:
+            raise Exception(f"Unknown tiling '{tiling}'. Use 'bbox' or 'h3'.")
+        print(f"Fetching {len(tiles)} WFS tiles")
+
+        frames = []
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            futures = [executor.submit(self._load_tile, tile, refresh) for tile in tiles]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                frame = future.result()
+                if frame is not None and len(frame) > 0:
+                    frames.append(frame)
+
+        if not frames:
+            return gpd.GeoDataFrame({'parcel_id': pd.Series(dtype=object)}, geometry=gpd.GeoSeries(crs="EPSG:4326"))
+
+        parcels = gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), geometry='geometry', crs=frames[0].crs or self.crs)
+        # Parcels crossing a tile border come with every tile they touch
+        id_col = next((col for col in ID_COLUMNS if col in parcels.columns), None)
+        if id_col is not None:
+            parcels = parcels.drop_duplicates(id_col).reset_index(drop=True)
+            parcels.insert(0, 'parcel_id', parcels[id_col].astype(str))
+        else:
+            parcels = parcels[~parcels.geometry.normalize().to_wkb().duplicated()].reset_index(drop=True)
+            parcels.insert(0, 'parcel_id', parcels.index.astype(str))
+
+        parcels = parcels.to_crs("EPSG:4326")
+        return parcels[parcels.intersects(area)].reset_index(drop=True)
+
+
+##############################################
+def fetch_parcels(area, tiling='bbox', client=None, **kwargs):
+    """
+    Fetches the cadastral parcels of a sub-municipal area through the WFS, see `WFSClient.fetch`.
+
+    Only the tiles covering the area are requested, so a few neighbourhoods take kilobytes
+    instead of the archive of a whole municipality. Cadastral parcels carry no dwelling counts;
+    these still come from the buildings of the ATOM archives.
+
+    Args:
+        area (shapely.Geometry or tuple): Polygon, or (minx, miny, maxx, maxy) box, in EPSG:4326.
+        tiling (str): 'bbox' or 'h3'.
+        client (WFSClient, optional): Client used for the requests. Defaults to a new client with the Settings.
+    Returns:
+        geopandas.GeoDataFrame: The parcels in EPSG:4326 with a 'parcel_id' column.
+    """
+    client = client or WFSClient()
+    return client.fetch(area, tiling=tiling, **kwargs)
@@ -1,84 +1,211 @@
+import argparse
 import geopandas as gpd
 import pandas as pd
-from shapely.geometry import Point
-from utils import count_houses, plot_ratio_map
-import osmnx as ox
+from utils import count_houses, compare_assignment, roll_up
 from catastro.atom import ATOM_Query
+import instrument
+from app_data import EDGES_PATH, TIMESERIES_PATH, DENSITY_PATH, PARCEL_STORE, LISTING_STORE, ROW_GROUP_SIZE, build_all_layer_caches, build_store
+from drilldown import NEAREST_MAX_DISTANCE, parcel_listing_counts
+from density import BANDWIDTH, CELL_SIZE, ratio_surfaces, write_surfaces
+from rendering import warm_render_cache
+from hexagons import H3_RESOLUTIONS, count_h3, write_h3
+from listings import read_listings
+from pipeline import Pipeline
+from streets import PLACE, load_edges, write_hotspot_edges
+from timeseries import count_snapshots, snapshot_paths
 import os
 
-rental_houses = [  'Entire rental unit', 
-            'Entire condo',
-            'Entire vacation home',
-            'Entire serviced apartment', 
-            'Entire home', 
-            'Entire loft',
-            'Entire townhouse', 
-            'Entire guest suite',
-            'Entire villa',
-            'Tiny home', 
-            'Entire guesthouse', 
-            'Entire cabin', 
-            'Entire place', 
-            'Entire chalet', 
-            'Casa particular', 
-            'Dome', 
-            'Yurt', 
-            'Entire hostel']
+ASSIGNMENT = 'point' # 'point' (representative points on a prepared STRtree) or 'intersects' (full parcel polygons)
+TIE_RULE = 'largest_overlap' # Section given to parcels straddling several: 'largest_overlap' or 'representative_point'
+COMPARE_ASSIGNMENT = True # Time both assignment methods on a sample of the parcels and report the change in counts
+COMPARE_SAMPLE = 50_000 # Parcels drawn for the comparison (None compares all of them)
+PARCEL_POINTS = False # Stream the GML keeping one representative point per building instead of its footprint
+OSM_FILE = None # Local OSM XML extract to build the street network from, instead of querying OpenStreetMap
 
-if __name__ == "__main__":
-    query = ATOM_Query('Barcelona', 'Barcelona')
-    parcels = query.download_gml()
-    parcels.to_crs("EPSG:4326", inplace=True)
-    
-    if not os.path.exists("data/barcelona.csv"):
-        raise FileNotFoundError("The file 'data/barcelona.csv' does not exist. Please download it from Inside Airbnb and place it in the 'data' directory.")
-        
-    bcn = pd.read_csv("data/barcelona.csv") #This needs to be downloaded from Inside Airbnb
-    bcn['geometry'] = gpd.points_from_xy(bcn['longitude'], bcn['latitude'])
-    bcn = gpd.GeoDataFrame(bcn, geometry='geometry', crs="EPSG:4326")
-    bcn['property_type_basic'] = bcn['property_type'].apply(lambda x: 'Flat' if x in rental_houses else 'Room')
-    flats = bcn[bcn['property_type_basic'] == 'Flat']
-    rooms = bcn[bcn['property_type_basic'] == 'Room']
-    ad_boundaries = gpd.read_file('data/0301100100_UNITATS_ADM_POLIGONS.json')
+LISTINGS_PATH = "data/barcelona.csv" # Downloaded from Inside Airbnb
+BOUNDARIES_PATH = 'data/0301100100_UNITATS_ADM_POLIGONS.json'
+SNAPSHOT_DIR = 'data/snapshots' # Inside Airbnb listing snapshots of several dates, for the time series
+SNAPSHOT_WORKERS = None # Processes counting the snapshots in parallel (None uses every CPU)
+STAGE_DIR = 'data/cache/pipeline' # Intermediate outputs of the stages
+REPORT_PATH = os.path.join(STAGE_DIR, 'report.json') # Time, memory, rows and downloads of every instrumented step
+
+# Intermediate outputs, passed between stages as (Geo)Parquet
+STAGE_FILES = {
+    'censal': os.path.join(STAGE_DIR, 'censal.parquet'),
+    'barris': os.path.join(STAGE_DIR, 'barris.parquet'),
+    'districts': os.path.join(STAGE_DIR, 'districts.parquet'),
+    'parcels': os.path.join(STAGE_DIR, 'parcels.parquet'),
+    'n_parcels': os.path.join(STAGE_DIR, 'n_parcels.parquet'),
+    'listings': os.path.join(STAGE_DIR, 'listings.parquet'),
+    'counts_censal': os.path.join(STAGE_DIR, 'counts_censal.parquet'),
+    'counts_barris': os.path.join(STAGE_DIR, 'counts_barris.parquet'),
+    'counts_districts': os.path.join(STAGE_DIR, 'counts_districts.parquet'),
+}
+H3_FILES = {resolution: os.path.join(STAGE_DIR, f'h3_{resolution}.parquet') for resolution in H3_RESOLUTIONS}
+
+pipeline = Pipeline(STAGE_DIR)
+
+
+
+@pipeline.stage('boundaries', inputs=[BOUNDARIES_PATH],
+                outputs=[STAGE_FILES['censal'], STAGE_FILES['barris'], STAGE_FILES['districts']])
+def boundaries_stage():
+    ad_boundaries = gpd.read_file(BOUNDARIES_PATH)
     ad_boundaries = ad_boundaries.to_crs('EPSG:4326')
-    censal = ad_boundaries[ad_boundaries['SCONJ_DESC']=='Secció censal']
+    censal = ad_boundaries[ad_boundaries['SCONJ_DESC']=='Secció censal'].copy()
     barris = ad_boundaries[ad_boundaries['SCONJ_DESC']=='Barri']
     districts = ad_boundaries[ad_boundaries['SCONJ_DESC']=='Districte']
-    barri_code = barris[['BARRI', 'NOM']]
-    censal['NOM'] = censal['BARRI'].apply(
-        lambda b: barri_code.loc[barri_code['BARRI'] == b, 'NOM'].iloc[0] 
-        if (barri_code['BARRI'] == b).any() 
-        else None
-    )
-
-    place = "Barcelona, Barcelona, Spain"
-    # Download street network
-    G = ox.graph_from_place(place, network_type="drive")
-    edges = ox.graph_to_gdfs(G, nodes=False)
-    
-    censal = count_houses(parcels, censal, out_label = 'n_parcels', parcel_id_col ='parcel_id', apartments_col  = 'numberOfDwellings')
-    censal = count_houses(flats, censal, out_label = 'n_flats', parcel_id_col ='id', apartments_col  = None)
-    censal = count_houses(rooms, censal, out_label = 'n_rooms', parcel_id_col ='id', apartments_col  = None)
-    censal['ratio_flats'] = 100*censal['n_flats'] / censal['n_parcels']
-    censal['ratio_rooms'] = 100*censal['n_rooms'] / censal['n_parcels']
-    censal['ratio'] = 100*(censal['n_flats']+censal['n_rooms']) / censal['n_parcels']
-    
-    barris = count_houses(parcels, barris, out_label = 'n_parcels', parcel_id_col ='parcel_id', apartments_col  = 'numberOfDwellings')
-    barris = count_houses(flats, barris, out_label = 'n_flats', parcel_id_col ='id', apartments_col  = None)
-    barris = count_houses(rooms, barris, out_label = 'n_rooms', parcel_id_col ='id', apartments_col  = None)
-    barris['ratio_flats'] = 100*barris['n_flats'] / barris['n_parcels']
-    barris['ratio_rooms'] = 100*barris['n_rooms'] / barris['n_parcels']
-    barris['ratio'] = 100*(barris['n_flats']+barris['n_rooms']) / barris['n_parcels']
-    
-    districts = count_houses(parcels, districts, out_label = 'n_parcels', parcel_id_col ='parcel_id', apartments_col  = 'numberOfDwellings')
-    districts = count_houses(flats, districts, out_label = 'n_flats', parcel_id_col ='id', apartments_col  = None)
-    districts = count_houses(rooms, districts, out_label = 'n_rooms', parcel_id_col ='id', apartments_col  = None)
-    districts['ratio_flats'] = 100*districts['n_flats'] / districts['n_parcels']
-    districts['ratio_rooms'] = 100*districts['n_rooms'] / districts['n_parcels']
-    districts['ratio'] = 100*(districts['n_flats']+districts['n_rooms']) / districts['n_parcels']
+    barri_code = barris.drop_duplicates('BARRI').set_index('BARRI')['NOM']
+    censal['NOM'] = censal['BARRI'].map(barri_code)
 
+    os.makedirs(STAGE_DIR, exist_ok=True)
+    censal.to_parquet(STAGE_FILES['censal'])
+    barris.to_parquet(STAGE_FILES['barris'])
+    districts.to_parquet(STAGE_FILES['districts'])
 
+
+
+# The cadastre is only fetched again on parameter changes or with --force cadastre, as its
+# content is not known before downloading it
+@pipeline.stage('cadastre', outputs=[STAGE_FILES['parcels']],
+                params={'province': 'Barcelona', 'municipality': 'Barcelona', 'points': PARCEL_POINTS})
+def cadastre_stage():
+    query = ATOM_Query('Barcelona', 'Barcelona')
+    parcels = query.download_gml(points=PARCEL_POINTS) # Cached as GeoParquet in EPSG:4326 after the first run
+    parcels.to_parquet(STAGE_FILES['parcels'], index=False)
+
+
+
+@pipeline.stage('assignment', after=['boundaries', 'cadastre'], outputs=[STAGE_FILES['n_parcels']],
+                params={'method': ASSIGNMENT, 'tie_rule': TIE_RULE})
+def assignment_stage():
+    parcels = gpd.read_parquet(STAGE_FILES['parcels'])
+    censal = gpd.read_parquet(STAGE_FILES['censal'])
+    if COMPARE_ASSIGNMENT:
+        compare_assignment(parcels, censal, parcel_id_col='parcel_id', apartments_col='numberOfDwellings', tie_rule=TIE_RULE,
+                           sample=COMPARE_SAMPLE)
+
+    # Dwellings per censal section, the denominator of every ratio
+    censal = count_houses(parcels, censal, 'n_parcels', parcel_id_col='parcel_id', apartments_col='numberOfDwellings',
+                          method=ASSIGNMENT, tie_rule=TIE_RULE)
+    censal[['n_parcels']].to_parquet(STAGE_FILES['n_parcels'])
+
+
+
+@pipeline.stage('listings', inputs=[LISTINGS_PATH], outputs=[STAGE_FILES['listings']])
+def listings_stage():
+    if not os.path.exists(LISTINGS_PATH):
+        raise FileNotFoundError(f"The file '{LISTINGS_PATH}' does not exist. Please download it from Inside Airbnb and place it in the 'data' directory.")
+    bcn = read_listings(LISTINGS_PATH)
+    bcn[['id', 'property_type_basic', 'geometry']].to_parquet(STAGE_FILES['listings'], index=False)
+
+
+
+@pipeline.stage('aggregation', after=['boundaries', 'cadastre', 'assignment', 'listings'],
+                outputs=[STAGE_FILES['counts_censal'], STAGE_FILES['counts_barris'], STAGE_FILES['counts_districts'],
+                         *H3_FILES.values(), DENSITY_PATH],
+                params={'method': ASSIGNMENT, 'tie_rule': TIE_RULE, 'h3': list(H3_RESOLUTIONS),
+                        'cell_size': CELL_SIZE, 'bandwidth': BANDWIDTH})
+def aggregation_stage():
+    bcn = gpd.read_parquet(STAGE_FILES['listings'])
+    flats = bcn[bcn['property_type_basic'] == 'Flat']
+    rooms = bcn[bcn['property_type_basic'] == 'Room']
+    censal = gpd.read_parquet(STAGE_FILES['censal'])
+    barris = gpd.read_parquet(STAGE_FILES['barris'])
+    districts = gpd.read_parquet(STAGE_FILES['districts'])
+
+    # Listings per censal section, next to the dwellings counted by the assignment stage
+    censal['n_parcels'] = pd.read_parquet(STAGE_FILES['n_parcels'])['n_parcels']
+    for out_label, gdf in (('n_flats', flats), ('n_rooms', rooms)):
+        censal = count_houses(gdf, censal, out_label, parcel_id_col='id', method=ASSIGNMENT, tie_rule=TIE_RULE)
+    censal, barris, districts = roll_up(censal, barris, districts, ['n_parcels', 'n_flats', 'n_rooms'])
+    censal.to_parquet(STAGE_FILES['counts_censal'])
+    barris.to_parquet(STAGE_FILES['counts_barris'])
+    districts.to_parquet(STAGE_FILES['counts_districts'])
+
+    # Same counts on the H3 grid, at several resolutions
+    parcels = gpd.read_parquet(STAGE_FILES['parcels'])
+    hexes = count_h3({'n_parcels': (parcels, 'numberOfDwellings'), 'n_flats': (flats, None), 'n_rooms': (rooms, None)})
+    for resolution, gdf in hexes.items():
+        gdf.to_parquet(H3_FILES[resolution], index=False)
+
+    # Hotspot surfaces on a regular grid, independent of the divisions
+    surfaces = ratio_surfaces({'ratio': bcn, 'ratio_flats': flats, 'ratio_rooms': rooms}, parcels, bounds=tuple(censal.total_bounds))
+    write_surfaces(surfaces, DENSITY_PATH)
+
+
+
+# Every snapshot reuses the dwellings per section of the assignment stage
+@pipeline.stage('timeseries', inputs=snapshot_paths(SNAPSHOT_DIR), after=['boundaries', 'assignment'], outputs=[TIMESERIES_PATH],
+                params={'method': ASSIGNMENT, 'tie_rule': TIE_RULE})
+def timeseries_stage():
+    censal = gpd.read_parquet(STAGE_FILES['censal'])
+    barris = gpd.read_parquet(STAGE_FILES['barris'])
+    districts = gpd.read_parquet(STAGE_FILES['districts'])
+    n_parcels = pd.read_parquet(STAGE_FILES['n_parcels'])['n_parcels']
+    series = count_snapshots(SNAPSHOT_DIR, censal, barris, districts, n_parcels, max_workers=SNAPSHOT_WORKERS,
+                             method=ASSIGNMENT, tie_rule=TIE_RULE)
+    print(f"Time series of {series['date'].nunique()} snapshots from '{SNAPSHOT_DIR}'")
+    series.to_parquet(TIMESERIES_PATH, index=False)
+
+
+
+@pipeline.stage('drilldown', after=['cadastre', 'listings'], outputs=[PARCEL_STORE, LISTING_STORE],
+                params={'row_group_size': ROW_GROUP_SIZE, 'max_distance': NEAREST_MAX_DISTANCE})
+def drilldown_stage():
+    parcels = gpd.read_parquet(STAGE_FILES['parcels'], columns=['parcel_id', 'numberOfDwellings', 'geometry'])
+    bcn = gpd.read_parquet(STAGE_FILES['listings'])
+    parcels = parcels.join(parcel_listing_counts(parcels, bcn))
+    # Stores of the building-level drill-down of the app, which reads them by viewport
+    build_store(parcels, PARCEL_STORE)
+    build_store(bcn, LISTING_STORE)
+
+
+
+@pipeline.stage('streets', inputs=[OSM_FILE], after=['boundaries'], outputs=[EDGES_PATH],
+                params={'place': PLACE, 'osm_file': OSM_FILE})
+def streets_stage():
+    censal = gpd.read_parquet(STAGE_FILES['censal'])
+    load_edges(osm_file=OSM_FILE, bbox=censal.total_bounds, force=True)
+
+
+
+@pipeline.stage('export', after=['aggregation', 'streets'],
+                outputs=['data/censal_sections.geojson', 'data/barris.geojson', 'data/districts.geojson',
+                         *(f'data/h3_{resolution}.geojson' for resolution in H3_RESOLUTIONS)])
+def export_stage():
+    censal = gpd.read_parquet(STAGE_FILES['counts_censal'])
+    barris = gpd.read_parquet(STAGE_FILES['counts_barris'])
+    districts = gpd.read_parquet(STAGE_FILES['counts_districts'])
     censal.to_file('data/censal_sections.geojson', driver='GeoJSON')
     barris.to_file('data/barris.geojson', driver='GeoJSON')
-    districts.to_file('data/districts.geojson', driver='GeoJSON')   
-    edges.to_file('data/edges.geojson', driver='GeoJSON')
\ No newline at end of file
+    districts.to_file('data/districts.geojson', driver='GeoJSON')
+    write_hotspot_edges(gpd.read_parquet(EDGES_PATH), censal)
+    write_h3({resolution: gpd.read_parquet(path) for resolution, path in H3_FILES.items()}, 'data')
+
+    # Binary, pre-simplified layers for the app
+    build_all_layer_caches()
+    # Map HTML and figures for every division and rental type
+    warm_render_cache()
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the datasets of the app, recomputing only the stages whose inputs changed.")
+    parser.add_argument('--stage', nargs='+', choices=list(pipeline.stages),
+                        help="Only bring these stages (and the stages they depend on) up to date.")
+    parser.add_argument('--force', nargs='+', default=[], choices=list(pipeline.stages) + ['all'],
+                        help="Run these stages even if their inputs did not change.")
+    parser.add_argument('--list', action='store_true', help="List the stages and whether they are up to date.")
+    parser.add_argument('--report', default=REPORT_PATH, help="JSON file receiving the run report.")
+    parser.add_argument('--profile', metavar='DIR', help="Dump a cProfile file per stage into this directory.")
+    args = parser.parse_args()
+
+    if args.list:
+        for name in pipeline.stages:
+            print(f"{name:<12} {'up to date' if pipeline.is_fresh(name) else 'stale'}")
+    else:
+        instrument.configure(report_path=args.report, profile_dir=args.profile)
+        pipeline.run(args.stage, force=args.force)
+        instrument.print_summary()
+        print(f"Run report written to '{instrument.write_report()}'")
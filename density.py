@@ -0,0 +1,149 @@
+import numpy as np
+import geopandas as gpd
+import pandas as pd
+import shapely
+from scipy.ndimage import gaussian_filter1d
+
+
+CELL_SIZE = 50 # Metres per side of the grid cells
+BANDWIDTH = 200 # Standard deviation of the Gaussian kernel, in metres
+MIN_DWELLINGS = 5 # Smoothed dwellings per cell below which the ratio is left blank (parks, port, mountain)
+TRUNCATE = 3 # Kernel radius, in bandwidths
+
+_METRES_PER_DEGREE = 111_320
+
+
+
+def _xy(gdf: gpd.GeoDataFrame):
+    points = shapely.point_on_surface(gdf.geometry.values.to_numpy())
+    return shapely.get_x(points), shapely.get_y(points)
+
+
+
+def grid_shape(bounds, cell_size: float = CELL_SIZE):
+    """
+    Number of rows and columns of a grid of `cell_size` metres over (minx, miny, maxx, maxy) in EPSG:4326,
+    with the cell sizes in degrees along each axis.
+
+    Returns:
+    - Tuple ((n_rows, n_cols), (dx, dy)).
+    """
+    minx, miny, maxx, maxy = bounds
+    dy = cell_size / _METRES_PER_DEGREE
+    dx = dy / np.cos(np.radians((miny + maxy) / 2))
+    return (max(int(np.ceil((maxy - miny) / dy)), 1), max(int(np.ceil((maxx - minx) / dx)), 1)), (dx, dy)
+
+
+
+def binned_counts(x, y, bounds, shape, weights=None) -> np.ndarray:
+    """
+    Sums the weights (or counts the points) falling in each cell of a grid over `bounds`.
+
+    Returns:
+    - float array of `shape` (rows from south to north).
+    """
+    minx, miny, maxx, maxy = bounds
+    counts, _, _ = np.histogram2d(y, x, bins=shape, range=[[miny, maxy], [minx, maxx]], weights=weights)
+    return counts
+
+
+
+def smooth(grid: np.ndarray, sigma_cells: float) -> np.ndarray:
+    """
+    Gaussian kernel smoothing of a grid as two 1D convolutions, one along each axis.
+    """
+    grid = gaussian_filter1d(grid, sigma_cells, axis=0, mode='constant', truncate=TRUNCATE)
+    return gaussian_filter1d(grid, sigma_cells, axis=1, mode='constant', truncate=TRUNCATE)
+
+
+
+def density_surface(listings: gpd.GeoDataFrame,
+                    parcels: gpd.GeoDataFrame,
+                    apartments_col: str = 'numberOfDwellings',
+                    bounds=None,
+                    cell_size: float = CELL_SIZE,
+                    bandwidth: float = BANDWIDTH,
+                    min_dwellings: float = MIN_DWELLINGS) -> dict:
+    """
+    Computes a continuous hotspot surface: the kernel density of listings divided by the kernel density
+    of dwellings, as a percentage, on a regular grid independent of any administrative boundary.
+
+    Listings and dwellings are binned once on the grid and both grids are smoothed with the same
+    separable Gaussian kernel, so the cost depends on the grid size and not on the number of points.
+
+    Parameters:
+    - listings: GeoDataFrame in EPSG:4326 with the listings (points).
+    - parcels: GeoDataFrame in EPSG:4326 with the parcels (points or polygons).
+    - apartments_col: Column of `parcels` with the dwellings per parcel.
+    - bounds: (minx, miny, maxx, maxy) of the grid. Defaults to the bounds of `parcels`.
+    - cell_size: Side of the grid cells, in metres.
+    - bandwidth: Standard deviation of the kernel, in metres.
+    - min_dwellings: Smoothed dwellings per cell below which the ratio is NaN.
+
+    Returns:
+    - dict with 'ratio' (float array, rows from south to north), 'bounds', 'cell_size' and 'bandwidth'.
+    """
+    return ratio_surfaces({'ratio': listings}, parcels, apartments_col, bounds, cell_size, bandwidth, min_dwellings)['ratio']
+
+
+
+def ratio_surfaces(layers: dict,
+                   parcels: gpd.GeoDataFrame,
+                   apartments_col: str = 'numberOfDwellings',
+                   bounds=None,
+                   cell_size: float = CELL_SIZE,
+                   bandwidth: float = BANDWIDTH,
+                   min_dwellings: float = MIN_DWELLINGS) -> dict:
+    """
+    Computes the surface of `density_surface` for several listing layers on the same grid,
+    smoothing the dwellings only once.
+
+    Parameters:
+    - layers: dict mapping a ratio column (e.g. 'ratio_flats') to a GeoDataFrame of listings.
+    - Other parameters as in `density_surface`.
+
+    Returns:
+    - dict mapping each ratio column to its surface.
+    """
+    if bounds is None:
+        bounds = tuple(parcels.total_bounds)
+    shape, (dx, dy) = grid_shape(bounds, cell_size)
+    # The grid covers whole cells, so the north-east corner moves out to the last cell edge
+    bounds = (bounds[0], bounds[1], bounds[0] + shape[1] * dx, bounds[1] + shape[0] * dy)
+    sigma = bandwidth / cell_size
+
+    px, py = _xy(parcels)
+    weights = pd.to_numeric(parcels[apartments_col], errors='coerce').fillna(0).to_numpy(dtype=float)
+    dwellings = smooth(binned_counts(px, py, bounds, shape, weights), sigma)
+
+    surfaces = {}
+    for col, listings in layers.items():
+        lx, ly = _xy(listings)
+        rentals = smooth(binned_counts(lx, ly, bounds, shape), sigma)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(dwellings >= min_dwellings, 100 * rentals / dwellings, np.nan)
+        surfaces[col] = {'ratio': ratio, 'bounds': bounds, 'cell_size': cell_size, 'bandwidth': bandwidth}
+    return surfaces
+
+
+
+def write_surfaces(surfaces: dict, path: str) -> None:
+    """
+    Writes several surfaces on the same grid, keyed by ratio column, as one compressed .npz file.
+    """
+    first = next(iter(surfaces.values()))
+    np.savez_compressed(path, bounds=np.asarray(first['bounds']), cell_size=first['cell_size'], bandwidth=first['bandwidth'],
+                        **{col: surface['ratio'].astype(np.float32) for col, surface in surfaces.items()})
+
+
+
+def read_surfaces(path: str) -> dict:
+    """
+    Reads the surfaces written by `write_surfaces`.
+
+    Returns:
+    - dict mapping each ratio column to a surface, as returned by `density_surface`.
+    """
+    with np.load(path) as data:
+        common = {'bounds': tuple(data['bounds']), 'cell_size': float(data['cell_size']), 'bandwidth': float(data['bandwidth'])}
+        return {col: {'ratio': data[col], **common} for col in data.files if col not in ('bounds', 'cell_size', 'bandwidth')}
@@ -0,0 +1,92 @@
+import os
+import folium
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from instrument import instrument
+from app_data import PARCEL_STORE, LISTING_STORE, read_viewport
+
+
+DRILLDOWN_ZOOM = 16 # Map zoom from which the parcels and listings of the viewport are drawn
+MAX_VIEWPORT_PARCELS = 5_000 # Parcels above which a viewport is too large to draw
+NEAREST_MAX_DISTANCE = 0.0015 # Degrees (about 150 m): Inside Airbnb shifts the location of listings by up to this
+VIEWPORT_PRECISION = 6 # Decimals of the coordinates sent to the browser
+
+
+
+def parcel_listing_counts(parcels: gpd.GeoDataFrame, listings: gpd.GeoDataFrame,
+                          max_distance: float = NEAREST_MAX_DISTANCE) -> pd.DataFrame:
+    """
+    Counts the flats and rooms of each parcel, giving every listing to the nearest parcel (the one
+    containing it, if any) within `max_distance` degrees.
+
+    Inside Airbnb shifts the published locations, so the counts of single buildings are indicative.
+
+    Returns:
+    - DataFrame aligned with `parcels` with the integer columns 'n_flats' and 'n_rooms'.
+    """
+    tree = shapely.STRtree(parcels.geometry.values.to_numpy())
+    listing_idx, parcel_idx = tree.query_nearest(listings.geometry.values.to_numpy(), max_distance=max_distance, all_matches=False)
+    basic = listings['property_type_basic'].to_numpy()[listing_idx]
+
+    counts = pd.DataFrame(index=parcels.index)
+    for out_label, kind in (('n_flats', 'Flat'), ('n_rooms', 'Room')):
+        counts[out_label] = np.bincount(parcel_idx[basic == kind], minlength=len(parcels)).astype('int32')
+    return counts
+
+
+
+def _geojson(gdf):
+    gdf = gdf.copy()
+    gdf.geometry = shapely.set_precision(gdf.geometry.values.to_numpy(), 10 ** -VIEWPORT_PRECISION)
+    gdf.index = range(len(gdf))
+    return gdf.__geo_interface__
+
+
+
+def build_drilldown_group(bbox, zoom: int):
+    """
+    Builds the layer of the parcels and listings inside a viewport, read from the spatially indexed
+    stores, so that only the viewport is ever loaded.
+
+    Parameters:
+    - bbox: (minx, miny, maxx, maxy) of the viewport in EPSG:4326, or None before the map reports it.
+    - zoom: Zoom of the map. Nothing is read below DRILLDOWN_ZOOM.
+
+    Returns:
+    - Tuple (group, message): a folium FeatureGroup (empty when nothing is drawn) and a status text.
+    """
+    group = folium.FeatureGroup(name='Buildings')
+    if bbox is None or zoom is None or zoom < DRILLDOWN_ZOOM:
+        return group, f"Zoom in to level {DRILLDOWN_ZOOM} to see the dwellings and listings of every building."
+    if not (os.path.exists(PARCEL_STORE) and os.path.exists(LISTING_STORE)):
+        return group, "The building-level data was not built. Run `python data_preprocessing.py --stage drilldown` to see it."
+
+    with instrument('drilldown.viewport') as record:
+        parcels = read_viewport(PARCEL_STORE, bbox, columns=['parcel_id', 'numberOfDwellings', 'n_flats', 'n_rooms'])
+        listings = read_viewport(LISTING_STORE, bbox, columns=['id', 'property_type_basic'])
+        record['rows'] = len(parcels) + len(listings)
+    if len(parcels) > MAX_VIEWPORT_PARCELS:
+        return group, f"{len(parcels)} buildings in view, zoom in further to draw them."
+
+    parcels['ratio'] = (100 * (parcels['n_flats'] + parcels['n_rooms']) / parcels['numberOfDwellings'].where(parcels['numberOfDwellings'] > 0)).round(1)
+    folium.GeoJson(
+        _geojson(parcels[['numberOfDwellings', 'n_flats', 'n_rooms', 'ratio', 'geometry']]),
+        # Parcels read as points (PARCEL_POINTS) are drawn as circles rather than default markers
+        marker=folium.CircleMarker(radius=5, fill=True),
+        style_function=lambda feature: {
+            'fillColor': '#b30000' if feature['properties']['n_flats'] + feature['properties']['n_rooms'] > 0 else '#bdbdbd',
+            'fillOpacity': 0.6,
+            'color': 'black',
+            'weight': 0.5,
+        },
+        tooltip=folium.GeoJsonTooltip(fields=['numberOfDwellings', 'n_flats', 'n_rooms', 'ratio'],
+                                      aliases=["Dwellings:", "Airbnb flats:", "Airbnb rooms:", "%:"]),
+    ).add_to(group)
+    folium.GeoJson(
+        _geojson(listings[['property_type_basic', 'geometry']].astype({'property_type_basic': str})),
+        marker=folium.CircleMarker(radius=3, weight=0, fill=True, fill_opacity=0.8),
+        style_function=lambda feature: {'fillColor': '#08519c' if feature['properties']['property_type_basic'] == 'Flat' else '#6baed6'},
+    ).add_to(group)
+    return group, f"{len(parcels)} buildings and {len(listings)} listings in view."
@@ -0,0 +1,187 @@
+import matplotlib
+matplotlib.use('Agg')
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from utils import plot_ratio_map
+import instrument
+from app_data import load_layer, layer_at, snapshot_dates
+from rendering import DIVISIONS, TYPES
+
+
+EXPORT_DIR = 'data/maps' # Output directory of the exported maps and their index
+EXPORT_FORMATS = ('png',) # 'png' and/or 'pdf'
+EXPORT_DPI = 150 # Resolution of the PNG maps
+BASE_WIDTH = 8 # Width in inches of the pre-rendered base, about that of the map axes, so line widths match
+BASE_DPI = 150 # Resolution of the pre-rendered base, also in the PDF maps; a finer base mostly costs resampling time
+LATEST = 'latest' # Name of the maps of the current data, as opposed to a snapshot date
+
+_worker_base = None
+
+
+
+def render_base(censal, edges, width: float = BASE_WIDTH, dpi: int = BASE_DPI) -> dict:
+    """
+    Renders the base layers shared by every map, the censal sections in grey with the street network
+    over them, once into an image that `plot_ratio_map` draws instead of plotting them again.
+
+    Returns:
+    - dict with 'image' (uint8 RGBA array, north up) and 'bounds' (minx, miny, maxx, maxy).
+    """
+    bounds = np.vstack([censal.total_bounds, edges.total_bounds]) if len(edges) else censal.total_bounds[None]
+    minx, miny = bounds[:, :2].min(axis=0)
+    maxx, maxy = bounds[:, 2:].max(axis=0)
+    # Same aspect as the geopandas plots of the maps
+    aspect = 1 / np.cos(np.radians((miny + maxy) / 2))
+    height = width * (maxy - miny) * aspect / (maxx - minx)
+
+    fig = plt.figure(figsize=(width, height), dpi=dpi)
+    fig.patch.set_alpha(0)
+    ax = fig.add_axes([0, 0, 1, 1])
+    censal.plot(ax=ax, color='lightgrey')
+    edges.plot(ax=ax, alpha=0.4, color='grey')
+    ax.set_xlim(minx, maxx)
+    ax.set_ylim(miny, maxy)
+    ax.set_aspect('auto')
+    ax.set_axis_off()
+    fig.canvas.draw()
+    image = np.asarray(fig.canvas.buffer_rgba()).copy()
+    plt.close(fig)
+    return {'image': image, 'bounds': (float(minx), float(miny), float(maxx), float(maxy))}
+
+
+
+def map_stem(division: str, type_label: str, date: str = None) -> str:
+    """
+    File name, without extension, of the map of a (division, type, snapshot date).
+    """
+    return f"{DIVISIONS[division]}_{TYPES[type_label]}_{date or LATEST}"
+
+
+
+def _init_worker(base):
+    global _worker_base
+    _worker_base = base
+
+
+
+def _export_map(division, type_label, date, out_dir, formats, dpi):
+    name, col = DIVISIONS[division], TYPES[type_label]
+    start = time.perf_counter()
+    layer = load_layer(name, 'map') if date is None else layer_at(name, date)
+    layer = layer[layer[col].notna()]
+
+    fig, ax = plt.subplots(figsize=(10, 10))
+    plot_ratio_map(layer, None, ax, ratio_col=col, base_image=_worker_base,
+                   title=f"Percentage of Airbnb ({type_label.lower()}) per {division.lower()}, {date or LATEST}")
+    files = {}
+    for fmt in formats:
+        files[fmt] = f"{map_stem(division, type_label, date)}.{fmt}"
+        fig.savefig(os.path.join(out_dir, files[fmt]), format=fmt, dpi=dpi)
+    plt.close(fig)
+
+    return {
+        'division': division,
+        'type': type_label,
+        'date': date or LATEST,
+        'rows': len(layer),
+        'min': float(layer[col].min()),
+        'max': float(layer[col].max()),
+        **files,
+        'seconds': round(time.perf_counter() - start, 3),
+    }
+
+
+
+def write_index(entries: list, out_dir: str) -> None:
+    """
+    Writes the index of the exported maps as 'index.json' and as an 'index.html' gallery.
+    """
+    with open(os.path.join(out_dir, 'index.json'), 'w') as f:
+        json.dump(entries, f, indent=1)
+
+    index = pd.DataFrame(entries)
+    formats = [fmt for fmt in ('png', 'pdf') if fmt in index.columns]
+    for fmt in formats:
+        link = (lambda file: f'<a href="{file}"><img src="{file}" width="200"></a>') if fmt == 'png' else (lambda file: f'<a href="{file}">{file}</a>')
+        index[fmt] = index[fmt].map(link)
+    html = index[['division', 'type', 'date', 'rows', 'min', 'max', *formats]].to_html(index=False, escape=False, float_format='{:.1f}'.format)
+    with open(os.path.join(out_dir, 'index.html'), 'w') as f:
+        f.write(f"<html><head><meta charset='utf-8'><title>Airbnb maps of Barcelona</title></head><body>{html}</body></html>")
+
+
+
+def export_maps(out_dir: str = EXPORT_DIR,
+                divisions=None,
+                types=None,
+                dates=None,
+                formats=EXPORT_FORMATS,
+                dpi: int = EXPORT_DPI,
+                max_workers: int = None) -> list:
+    """
+    Exports a static map for every (division, rental type, snapshot date), headless and in parallel.
+
+    The base layers are rendered once and sent to every worker process when it starts, so each map only
+    draws its own polygons over an image instead of plotting the censal sections and the whole street
+    network again. In the PDF maps the base layers are therefore a raster of BASE_DPI.
+
+    Parameters:
+    - out_dir: Directory receiving the maps and their index.
+    - divisions: Keys of DIVISIONS to export (None exports all).
+    - types: Keys of TYPES to export (None exports all).
+    - dates: Snapshot dates to export, None standing for the current data. Defaults to the current
+      data and every date of the time series.
+    - formats: Output formats, 'png' and/or 'pdf'.
+    - dpi: Resolution of the PNG maps.
+    - max_workers: Processes of the pool (defaults to the number of CPUs).
+
+    Returns:
+    - List of the index entries, one per map.
+    """
+    divisions = list(divisions or DIVISIONS)
+    types = list(types or TYPES)
+    dates = [None] + snapshot_dates() if dates is None else list(dates)
+    os.makedirs(out_dir, exist_ok=True)
+
+    with instrument.instrument('export_maps.base') as record:
+        # Loading the layers here also builds their GeoParquet variants before the workers read them
+        for division in divisions:
+            load_layer(DIVISIONS[division], 'map')
+        censal, edges = load_layer('censal', 'map'), load_layer('edges', 'map')
+        record['rows'] = len(censal) + len(edges)
+        base = render_base(censal, edges)
+
+    jobs = [(division, type_label, date) for division in divisions for type_label in types for date in dates]
+    print(f"Exporting {len(jobs)} maps to '{out_dir}'")
+    with instrument.instrument('export_maps.maps', rows=len(jobs)), \
+            ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(base,)) as executor:
+        futures = [executor.submit(_export_map, *job, out_dir, tuple(formats), dpi) for job in jobs]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result()
+    entries = [future.result() for future in futures]
+    write_index(entries, out_dir)
+    return entries
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports static maps of every division, rental type and snapshot date, with an index.")
+    parser.add_argument('--output', default=EXPORT_DIR, help="Directory receiving the maps and their index.")
+    parser.add_argument('--division', nargs='+', choices=list(DIVISIONS), help="Divisions to export (default: all).")
+    parser.add_argument('--type', nargs='+', choices=list(TYPES), help="Rental types to export (default: all).")
+    parser.add_argument('--date', nargs='+', help=f"Snapshot dates to export, '{LATEST}' for the current data (default: all).")
+    parser.add_argument('--format', nargs='+', choices=['png', 'pdf'], default=list(EXPORT_FORMATS))
+    parser.add_argument('--dpi', type=int, default=EXPORT_DPI)
+    parser.add_argument('--workers', type=int, default=None, help="Processes of the pool (default: one per CPU).")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    dates = None if args.date is None else [None if date == LATEST else date for date in args.date]
+    entries = export_maps(args.output, args.division, args.type, dates, args.format, args.dpi, args.workers)
+    print(f"{len(entries)} maps exported in {time.perf_counter() - start:.1f} s, index written to '{os.path.join(args.output, 'index.html')}'")
@@ -0,0 +1,118 @@
+import os
+import geopandas as gpd
+import h3
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import Polygon
+from catastro.settings import Settings
+from utils import add_ratios
+
+
+H3_RESOLUTIONS = (7, 8, Settings.H3_ZOOM)
+
+# Bit layout of an H3 index: 4 bits of resolution at bit 52, then one 3-bit digit per resolution
+_RES_OFFSET = 52
+_RES_MASK = np.uint64(0xF << _RES_OFFSET)
+_latlng_to_cell = np.frompyfunc(h3.api.basic_int.latlng_to_cell, 3, 1)
+
+
+
+def points_to_cells(lon: np.ndarray, lat: np.ndarray, resolution: int) -> np.ndarray:
+    """
+    Indexes arrays of coordinates to H3 cells at a resolution. Coordinates must be finite.
+
+    Returns:
+    - uint64 array of H3 cells.
+    """
+    return _latlng_to_cell(np.asarray(lat, dtype=float), np.asarray(lon, dtype=float), resolution).astype(np.uint64)
+
+
+
+def cells_to_parent(cells: np.ndarray, resolution: int) -> np.ndarray:
+    """
+    Vectorized parent of an array of H3 cells, computed on the index bits: the resolution field is
+    set to `resolution` and the digits of the finer resolutions are set to 7 (unused).
+
+    All cells must share the same resolution, finer than or equal to `resolution`.
+    """
+    cells = np.asarray(cells, dtype=np.uint64)
+    if len(cells) == 0:
+        return cells
+    child_resolution = h3.get_resolution(h3.int_to_str(int(cells[0])))
+    parents = (cells & ~_RES_MASK) | np.uint64(resolution << _RES_OFFSET)
+    for r in range(resolution + 1, child_resolution + 1):
+        parents |= np.uint64(7 << ((15 - r) * 3))
+    return parents
+
+
+
+def _points(gdf: gpd.GeoDataFrame):
+    # NaN for missing and empty geometries
+    points = shapely.point_on_surface(gdf.geometry.values.to_numpy())
+    points[shapely.is_empty(points)] = None
+    return shapely.get_x(points), shapely.get_y(points)
+
+
+
+def _cell_polygons(cells: np.ndarray) -> list:
+    polygons = []
+    for cell in cells:
+        boundary = h3.cell_to_boundary(h3.int_to_str(int(cell)))
+        polygons.append(Polygon([(lng, lat) for lat, lng in boundary]))
+    return polygons
+
+
+
+def count_h3(layers: dict, resolutions=H3_RESOLUTIONS) -> dict:
+    """
+    Counts every input layer per H3 cell at several resolutions, without any polygon overlay.
+
+    Every feature is reduced to a representative point and indexed once, at the finest resolution.
+    Coarser resolutions are rolled up from the finest cells through their parents, so the counts of
+    the children always add up to their parent.
+
+    Parameters:
+    - layers: dict mapping an output label to a tuple (gdf, apartments_col), where `gdf` is in
+      EPSG:4326 and `apartments_col` holds the apartment count per feature (None counts each feature as 1).
+    - resolutions: H3 resolutions to produce.
+
+    Returns:
+    - dict mapping each resolution to a GeoDataFrame with the 'h3' cell, one column per layer and,
+      when the labels 'n_parcels', 'n_flats' and 'n_rooms' are present, the ratio columns.
+    """
+    finest = max(resolutions)
+    counts = []
+    for out_label, (gdf, apartments_col) in layers.items():
+        lon, lat = _points(gdf)
+        weights = np.ones(len(gdf)) if apartments_col is None else pd.to_numeric(gdf[apartments_col], errors='coerce').fillna(0).to_numpy()
+        # Empty or missing geometries have no coordinates, which H3 cannot index
+        valid = np.isfinite(lon) & np.isfinite(lat)
+        if not valid.all():
+            print(f"Skipping {(~valid).sum()} features of '{out_label}' without coordinates")
+        cells = points_to_cells(lon[valid], lat[valid], finest)
+        weights = weights[valid]
+        counts.append(pd.Series(weights, index=cells).groupby(level=0).sum().rename(out_label))
+    finest_counts = pd.concat(counts, axis=1).fillna(0).astype(int)
+
+    levels = {}
+    for resolution in sorted(resolutions, reverse=True):
+        parents = cells_to_parent(finest_counts.index.to_numpy(), resolution)
+        level = finest_counts.groupby(parents).sum()
+        gdf = gpd.GeoDataFrame(level.reset_index(drop=True),
+                               geometry=_cell_polygons(level.index.to_numpy()),
+                               crs="EPSG:4326")
+        gdf.insert(0, 'h3', [h3.int_to_str(int(cell)) for cell in level.index])
+        if {'n_parcels', 'n_flats', 'n_rooms'}.issubset(layers):
+            gdf = add_ratios(gdf)
+        levels[resolution] = gdf
+    return levels
+
+
+
+def write_h3(levels: dict, out_dir: str = 'data') -> None:
+    """
+    Writes each resolution of `count_h3` as data/h3_<resolution>.geojson.
+    """
+    for resolution, gdf in levels.items():
+        gdf.to_file(os.path.join(out_dir, f'h3_{resolution}.geojson'), driver='GeoJSON')
@@ -0,0 +1,240 @@
+import atexit
+import cProfile
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Report and cProfile output, also configurable through the environment (e.g. for `streamlit run`)
+_config = {
+    'report_path': os.environ.get('INSTRUMENT_REPORT'),
+    'profile_dir': os.environ.get('INSTRUMENT_PROFILE_DIR'),
+}
+_records = [] # Finished stages, kept only while a report path is configured
+_profiles = [0] # Profile dumps written, numbering their files
+_lock = threading.Lock()
+_local = threading.local()
+_active = [0] # Stages running in any thread
+_started = datetime.now(timezone.utc).isoformat(timespec='seconds')
+
+# Linux exposes the peak RSS of the process in /proc and lets it be reset, which gives a peak per stage
+_PROC_STATUS = '/proc/self/status'
+_PROC_CLEAR_REFS = '/proc/self/clear_refs'
+
+
+##############################################
+def _peak_rss_mb():
+    try:
+        with open(_PROC_STATUS) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Peak of the whole process so far, in KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def _reset_peak_rss():
+    try:
+        with open(_PROC_CLEAR_REFS, 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+##############################################
+def configure(report_path=None, profile_dir=None):
+    """
+    Sets where the run report is written at exit and where the per-stage cProfile dumps go.
+
+    Args:
+        report_path (str, optional): JSON file the run report is written to when the process exits.
+            If None, the finished stages are not kept, so long-running processes do not accumulate them.
+        profile_dir (str, optional): Directory receiving one .prof file per instrumented stage. If None,
+            stages are not profiled.
+    """
+    _config['report_path'] = report_path
+    _config['profile_dir'] = profile_dir
+
+
+##############################################
+@contextmanager
+def instrument(stage, rows=None):
+    """
+    Records the wall time, peak RSS, rows and downloaded bytes of a block of code.
+
+    The record is yielded, so the block can set its row count once known (`record['rows'] = n`).
+    Downloaded bytes are added by the download functions through `add_bytes`. Stages can be nested:
+    the peak RSS and bytes of an inner stage also count for the stages enclosing it. When a profile
+    directory is configured, the outermost stage of each thread is profiled with cProfile.
+
+    The peak RSS is that of the whole process. Linux can only reset it for the whole process, so it is
+    reset only when an outermost stage starts on the main thread with no stage running in any other
+    thread. Other stages report the peak since the last reset, which can include earlier or
+    concurrent work but never understates their own.
+
+    Args:
+        stage (str): Name of the stage in the report.
+        rows (int, optional): Number of rows the stage processes, if known beforehand.
+    Yields:
+        dict: The record of the stage.
+    """
+    stack = _stack()
+    with _lock:
+        # Resetting the peak under a running stage, of this or another thread, would lose its peak
+        if not stack and _active[0] == 0 and threading.current_thread() is threading.main_thread():
+            _reset_peak_rss()
+        _active[0] += 1
+
+    record = {
+        'stage': stage,
+        'start': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+        'seconds': None,
+        'peak_rss_mb': _peak_rss_mb(),
+        'rows': rows,
+        'bytes_downloaded': 0,
+        'thread': threading.current_thread().name,
+        'profile': None,
+        'error': None,
+    }
+    profiler = None
+    if _config['profile_dir'] and not any(parent['profile'] for parent in stack):
+        os.makedirs(_config['profile_dir'], exist_ok=True)
+        with _lock:
+            record['profile'] = os.path.join(_config['profile_dir'], f"{_profiles[0]:04d}_{stage.replace(':', '_')}.prof")
+            _profiles[0] += 1
+        profiler = cProfile.Profile()
+
+    stack.append(record)
+    start = time.perf_counter()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        yield record
+    except BaseException as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(record['profile'])
+        record['seconds'] = round(time.perf_counter() - start, 6)
+        stack.pop()
+        record['peak_rss_mb'] = round(max(record['peak_rss_mb'], _peak_rss_mb()), 1)
+        with _lock:
+            _active[0] -= 1
+            if _config['report_path']:
+                _records.append(record)
+
+
+##############################################
+def instrumented(stage=None, rows=None):
+    """
+    Decorator running a function inside `instrument`.
+
+    Args:
+        stage (str, optional): Name of the stage. Defaults to the qualified name of the function.
+        rows (callable, optional): Function of the return value giving the row count, e.g. `len`.
+    """
+    def decorator(func):
+        name = stage or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with instrument(name) as record:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    record['rows'] = rows(result)
+                return result
+        return wrapper
+    return decorator
+
+
+##############################################
+def add_bytes(n):
+    """
+    Adds `n` downloaded bytes to every stage running in the current thread.
+    """
+    for record in _stack():
+        record['bytes_downloaded'] += n
+
+
+##############################################
+def records():
+    """
+    Returns a copy of the records of the finished stages, in order of completion, kept while a report
+    path is configured.
+    """
+    with _lock:
+        return [dict(record) for record in _records]
+
+
+def report():
+    """
+    Builds the run report: the records of every stage and their totals per stage name.
+
+    Returns:
+        dict: Report with 'started', 'finished', 'argv', 'stages' and 'totals'.
+    """
+    stages = records()
+    totals = {}
+    for record in stages:
+        total = totals.setdefault(record['stage'], {'calls': 0, 'seconds': 0.0, 'peak_rss_mb': 0.0, 'rows': 0, 'bytes_downloaded': 0})
+        total['calls'] += 1
+        total['seconds'] = round(total['seconds'] + record['seconds'], 6)
+        total['peak_rss_mb'] = max(total['peak_rss_mb'], record['peak_rss_mb'])
+        total['rows'] += record['rows'] or 0
+        total['bytes_downloaded'] += record['bytes_downloaded']
+    return {
+        'started': _started,
+        'finished': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'argv': sys.argv,
+        'stages': stages,
+        'totals': totals,
+    }
+
+
+def write_report(path=None):
+    """
+    Writes the run report as JSON.
+
+    Args:
+        path (str, optional): Output file. Defaults to the configured report path.
+    Returns:
+        str: Path of the report, or None if no path is configured.
+    """
+    path = path or _config['report_path']
+    if path is None:
+        return None
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(report(), f, indent=1)
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def print_summary():
+    """
+    Prints the totals of the run report per stage name, slowest first.
+    """
+    totals = report()['totals']
+    print(f"{'stage':<40} {'calls':>5} {'seconds':>9} {'peak MB':>8} {'rows':>10} {'MB down':>8}")
+    for stage, total in sorted(totals.items(), key=lambda item: -item[1]['seconds']):
+        print(f"{stage:<40} {total['calls']:>5} {total['seconds']:>9.2f} {total['peak_rss_mb']:>8.0f} "
+              f"{total['rows']:>10} {total['bytes_downloaded']/1e6:>8.1f}")
+
+
+atexit.register(write_report)
@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from pandas.api.types import union_categoricals
+
+
+# Property types of Inside Airbnb counted as whole flats; every other type is a room
+rental_houses = [  'Entire rental unit',
+            'Entire condo',
+            'Entire vacation home',
+            'Entire serviced apartment',
+            'Entire home',
+            'Entire loft',
+            'Entire townhouse',
+            'Entire guest suite',
+            'Entire villa',
+            'Tiny home',
+            'Entire guesthouse',
+            'Entire cabin',
+            'Entire place',
+            'Entire chalet',
+            'Casa particular',
+            'Dome',
+            'Yurt',
+            'Entire hostel']
+
+# Only columns of the listings file the analysis uses, with explicit dtypes
+LISTING_DTYPES = {
+    'id': 'int64',
+    'latitude': 'float64',
+    'longitude': 'float64',
+    'property_type': 'category',
+}
+
+
+
+def classify_listings(property_type: pd.Series) -> pd.Categorical:
+    """
+    Classifies listings as 'Flat' or 'Room' from their property type, vectorized.
+    """
+    return pd.Categorical(np.where(property_type.isin(rental_houses), 'Flat', 'Room'), categories=['Flat', 'Room'])
+
+
+
+def read_listings(path: str, chunksize: int = 200_000) -> gpd.GeoDataFrame:
+    """
+    Reads an Inside Airbnb listings file (plain or compressed, e.g. listings.csv.gz), keeping only
+    the columns in LISTING_DTYPES and streaming it in chunks so that the text columns are never loaded.
+
+    Parameters:
+    - path: Path of the listings CSV.
+    - chunksize: Rows parsed at a time.
+
+    Returns:
+    - GeoDataFrame in EPSG:4326 with 'id', categorical 'property_type' and 'property_type_basic'
+      ('Flat' or 'Room'), and point geometries.
+    """
+    chunks = []
+    for chunk in pd.read_csv(path, usecols=list(LISTING_DTYPES), dtype=LISTING_DTYPES, chunksize=chunksize, compression='infer'):
+        chunk['property_type_basic'] = classify_listings(chunk['property_type'])
+        chunks.append(chunk)
+
+    property_type = union_categoricals([chunk['property_type'] for chunk in chunks]) if chunks else pd.Categorical([])
+    listings = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=list(LISTING_DTYPES) + ['property_type_basic'])
+    listings['property_type'] = property_type
+    listings['property_type_basic'] = pd.Categorical(listings['property_type_basic'], categories=['Flat', 'Room'])
+
+    return gpd.GeoDataFrame(listings.drop(columns=['longitude', 'latitude']),
+                            geometry=gpd.points_from_xy(listings['longitude'], listings['latitude']),
+                            crs="EPSG:4326")
@@ -0,0 +1,136 @@
+import time
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from app_data import LAYERS
+from timeseries import division_code
+
+
+
+class SectionLookup():
+    """
+    In-memory lookup of the censal section, barri and district of batches of points.
+
+    The sections are indexed once in an STRtree and prepared, so every batch is answered with one
+    bounding-box query of the tree and one vectorized point-in-polygon test of the candidates.
+    Instances can be pickled: only the geometries (as WKB) and the codes are serialized, and the
+    tree is rebuilt when loading, which takes milliseconds.
+
+    Parameters:
+    - censal: GeoDataFrame with the censal sections in EPSG:4326 and their 'DISTRICTE', 'SEC_CENS'
+      and 'BARRI' codes.
+    """
+    def __init__(self, censal: gpd.GeoDataFrame):
+        censal = censal.to_crs("EPSG:4326")
+        self._codes = pd.DataFrame({
+            'section': division_code(censal, 'censal').to_numpy(),
+            'barri': censal['BARRI'].astype(str).to_numpy(),
+            'district': censal['DISTRICTE'].astype(str).to_numpy(),
+        })
+        self._build(censal.geometry.values.to_numpy())
+
+    ##################################################
+
+    @classmethod
+    def from_file(cls, path: str = LAYERS['censal']):
+        """
+        Builds the lookup from a censal sections file (GeoJSON or GeoParquet).
+        """
+        return cls(gpd.read_parquet(path) if path.endswith('.parquet') else gpd.read_file(path))
+
+    def _build(self, geoms):
+        self._geoms = geoms
+        shapely.prepare(self._geoms)
+        self._tree = shapely.STRtree(self._geoms)
+
+    def __getstate__(self):
+        return {'wkb': shapely.to_wkb(self._geoms), 'codes': self._codes}
+
+    def __setstate__(self, state):
+        self._codes = state['codes']
+        self._build(shapely.from_wkb(state['wkb']))
+
+    ##################################################
+
+    @property
+    def codes(self):
+        return self._codes
+
+    @property
+    def bounds(self):
+        return shapely.total_bounds(self._geoms)
+
+    def __len__(self):
+        return len(self._geoms)
+
+    ##################################################
+
+    def section_index(self, lon, lat) -> np.ndarray:
+        """
+        Position of the section containing each point, or -1 for points outside every section.
+        Points inside several (overlapping) sections get the one with the lowest position.
+
+        Parameters:
+        - lon, lat: Arrays of coordinates in EPSG:4326.
+
+        Returns:
+        - int64 array with one position per point.
+        """
+        lon = np.asarray(lon, dtype=float)
+        lat = np.asarray(lat, dtype=float)
+        points, sections = self._tree.query(shapely.points(lon, lat))
+        inside = shapely.contains_xy(self._geoms[sections], lon[points], lat[points])
+        points, sections = points[inside], sections[inside]
+
+        index = np.full(len(lon), -1, dtype=np.int64)
+        # Explicit tie-break, as neither the tree nor duplicate fancy assignment guarantee an order
+        order = np.lexsort((sections, points))
+        first = np.unique(points[order], return_index=True)[1]
+        index[points[order][first]] = sections[order][first]
+        return index
+
+    def lookup(self, lon, lat) -> pd.DataFrame:
+        """
+        Codes of the censal section, barri and district of each point.
+
+        Parameters:
+        - lon, lat: Arrays of coordinates in EPSG:4326.
+
+        Returns:
+        - DataFrame with one row per point and the columns 'section', 'barri' and 'district'
+          (None for points outside every section).
+        """
+        index = self.section_index(lon, lat)
+        codes = self._codes.reindex(index).reset_index(drop=True)
+        return codes.astype(object).where(codes.notna(), None)
+
+
+
+def benchmark_lookup(lookup: SectionLookup, n_points: int = 1_000_000, batch_size: int = 100_000, seed: int = 0) -> float:
+    """
+    Measures the throughput of `lookup` on random points inside the bounds of the sections.
+
+    Returns:
+    - Points per second.
+    """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = lookup.bounds
+    lon = rng.uniform(minx, maxx, n_points)
+    lat = rng.uniform(miny, maxy, n_points)
+
+    start = time.perf_counter()
+    matched = 0
+    for i in range(0, n_points, batch_size):
+        matched += int((lookup.section_index(lon[i:i+batch_size], lat[i:i+batch_size]) >= 0).sum())
+    seconds = time.perf_counter() - start
+    print(f"{n_points} points in {seconds:.2f} s: {n_points/seconds:,.0f} points/s ({100*matched/n_points:.0f}% inside a section)")
+    return n_points / seconds
+
+
+
+if __name__ == "__main__":
+    start = time.perf_counter()
+    lookup = SectionLookup.from_file()
+    print(f"Built the lookup of {len(lookup)} sections in {time.perf_counter() - start:.2f} s")
+    benchmark_lookup(lookup)
@@ -0,0 +1,214 @@
+import hashlib
+import json
+import os
+import time
+from instrument import instrument
+
+
+STATE_DIR = 'data/cache/pipeline'
+
+
+
+def _digest_key(path: str) -> str:
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+
+def file_digest(path: str, memo: dict = None) -> str:
+    """
+    SHA-1 of the content of a file. When a `memo` dict is given, digests are reused for files whose
+    size and modification time did not change since they were hashed.
+    """
+    key = _digest_key(path)
+    if memo is not None and key in memo:
+        return memo[key]
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    if memo is not None:
+        memo[key] = digest.hexdigest()
+    return digest.hexdigest()
+
+
+
+class Stage():
+    """
+    A named step of the pipeline.
+
+    Parameters:
+    - name: Name of the stage, used on the command line.
+    - func: Callable running the stage. It reads its inputs and writes its outputs to disk.
+    - inputs: Paths of the files the stage reads that are not produced by other stages.
+    - after: Names of the upstream stages whose outputs the stage reads.
+    - outputs: Paths of the files the stage writes.
+    - params: JSON-serializable parameters that change the result of the stage.
+    """
+    def __init__(self, name, func, inputs=(), after=(), outputs=(), params=None):
+        self._name = name
+        self._func = func
+        self._inputs = list(inputs)
+        self._after = list(after)
+        self._outputs = list(outputs)
+        self._params = params or {}
+
+    ##################################################
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def func(self):
+        return self._func
+
+    @property
+    def inputs(self):
+        return [path for path in self._inputs if path is not None]
+
+    @property
+    def after(self):
+        return self._after
+
+    @property
+    def outputs(self):
+        return self._outputs
+
+    @property
+    def params(self):
+        return self._params
+
+
+
+class Pipeline():
+    """
+    Runs stages in declaration order, recomputing only those whose fingerprint changed.
+
+    The fingerprint of a stage hashes its parameters, the content of its input files and the content
+    of the outputs of its upstream stages. It is stored, with the digests of the outputs, in a state
+    file, so a stage whose inputs did not change is skipped as long as its outputs are still on disk.
+    """
+    def __init__(self, state_dir=STATE_DIR):
+        self._state_dir = state_dir
+        self._stages = {}
+        self._state_path = os.path.join(state_dir, 'state.json')
+        self._state = {'stages': {}, 'digests': {}}
+        if os.path.exists(self._state_path):
+            with open(self._state_path) as f:
+                self._state = json.load(f)
+
+    ##################################################
+
+    @property
+    def state_dir(self):
+        return self._state_dir
+
+    @property
+    def stages(self):
+        return self._stages
+
+    ##################################################
+
+    def stage(self, name, inputs=(), after=(), outputs=(), params=None):
+        """
+        Decorator registering a function as a stage, see `Stage`.
+        """
+        def register(func):
+            for upstream in after:
+                if upstream not in self._stages:
+                    raise ValueError(f"Stage '{name}' depends on unknown stage '{upstream}'.")
+            self._stages[name] = Stage(name, func, inputs, after, outputs, params)
+            return func
+        return register
+
+    ##################################################
+
+    def _save_state(self):
+        # Only the digests of the current versions of the files can be reused
+        current = {_digest_key(path) for stage in self._stages.values() for path in stage.inputs + stage.outputs
+                   if os.path.exists(path)}
+        self._state['digests'] = {key: digest for key, digest in self._state['digests'].items() if key in current}
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(self._state_path + '.tmp', 'w') as f:
+            json.dump(self._state, f, indent=1)
+        os.replace(self._state_path + '.tmp', self._state_path)
+
+    def fingerprint(self, name):
+        stage = self._stages[name]
+        digest = hashlib.sha1()
+        digest.update(json.dumps({'stage': name, 'params': stage.params}, sort_keys=True, default=str).encode())
+        for path in stage.inputs:
+            digest.update(path.encode())
+            digest.update(file_digest(path, self._state['digests']).encode() if os.path.exists(path) else b'missing')
+        for upstream in stage.after:
+            digest.update(json.dumps(self._state['stages'].get(upstream, {}).get('outputs', {}), sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def is_fresh(self, name):
+        """
+        Whether a stage is up to date: its fingerprint is the recorded one, its outputs are on disk
+        and every upstream stage is up to date too (a stale upstream stage may change its outputs).
+        """
+        record = self._state['stages'].get(name)
+        return (record is not None
+                and record['fingerprint'] == self.fingerprint(name)
+                and all(os.path.exists(path) for path in self._stages[name].outputs)
+                and all(self.is_fresh(upstream) for upstream in self._stages[name].after))
+
+    def _closure(self, names):
+        selected = set()
+        def visit(name):
+            if name not in self._stages:
+                raise ValueError(f"Unknown stage '{name}'. Available stages: {', '.join(self._stages)}")
+            if name not in selected:
+                selected.add(name)
+                for upstream in self._stages[name].after:
+                    visit(upstream)
+        for name in names:
+            visit(name)
+        return selected
+
+    ##################################################
+
+    def run(self, stages=None, force=()):
+        """
+        Runs the pipeline.
+
+        Parameters:
+        - stages: Names of the stages to bring up to date, together with their upstream stages.
+          If None, every stage is considered.
+        - force: Names of the stages to run even if they are up to date ('all' forces every stage).
+
+        Returns:
+        - dict mapping the name of each considered stage to 'ran' or 'skipped'.
+        """
+        selected = self._closure(stages) if stages else set(self._stages)
+        unknown = set(force) - set(self._stages) - {'all'}
+        if unknown:
+            raise ValueError(f"Unknown stages {sorted(unknown)}. Available stages: {', '.join(self._stages)}")
+        force = set(self._stages) if 'all' in force else set(force)
+        report = {}
+        for name, stage in self._stages.items():
+            if name not in selected:
+                continue
+            if name not in force and self.is_fresh(name):
+                print(f"[{name}] up to date")
+                report[name] = 'skipped'
+                continue
+
+            print(f"[{name}] running")
+            fingerprint = self.fingerprint(name)
+            start = time.perf_counter()
+            with instrument(f"stage:{name}"):
+                stage.func()
+            self._state['stages'][name] = {
+                'fingerprint': fingerprint,
+                'outputs': {path: file_digest(path, self._state['digests']) for path in stage.outputs},
+                'seconds': round(time.perf_counter() - start, 3),
+            }
+            self._save_state()
+            print(f"[{name}] done in {self._state['stages'][name]['seconds']:.1f} s")
+            report[name] = 'ran'
+        return report
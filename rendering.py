@@ -0,0 +1,329 @@
+import hashlib
+import os
+import threading
+from functools import lru_cache
+from io import BytesIO
+import json
+import branca
+import folium
+import matplotlib as mpl
+import geopandas as gpd
+import matplotlib.pyplot as plt
+import numpy as np
+import shapely
+from utils import plot_ratio_map
+from instrument import instrument
+from app_data import LAYERS, CACHE_DIR, HOTSPOT_THRESHOLD, TIMESERIES_PATH, DENSITY_PATH, load_layer, load_hotspot_edges, layer_at, load_density, clear_caches
+
+
+# Selectbox options of the app and the layer / column they map to
+DIVISIONS = {
+    "Censal Sections": 'censal',
+    "Neighborhoods": 'barris',
+    "Districts": 'districts',
+}
+TYPES = {
+    "All": 'ratio',
+    "Full aparments": 'ratio_flats',
+    "Rooms": 'ratio_rooms',
+}
+
+RENDER_DIR = os.path.join(CACHE_DIR, 'render')
+MAP_PRECISION = 5 # Decimals of the coordinates sent to the browser
+
+title_fontsize = 20
+label_fontsize = 16
+
+# Matplotlib is not thread-safe and Streamlit serves every session from its own thread
+_render_lock = threading.Lock()
+# Last data version seen by this process, whose data the loaders of app_data hold
+_loaded_version = {'version': None}
+_version_lock = threading.Lock()
+
+
+
+def data_version() -> str:
+    """
+    Short fingerprint of the data files the views are rendered from (paths, sizes and modification times).
+
+    The layers loaded by the process are not keyed by version, so they are dropped when the version
+    changes; otherwise views of the new version would be rendered from the old data.
+    """
+    digest = hashlib.sha1()
+    for path in sorted([*LAYERS.values(), TIMESERIES_PATH, DENSITY_PATH]):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    version = digest.hexdigest()[:12]
+    with _version_lock:
+        if _loaded_version['version'] not in (None, version):
+            clear_caches()
+        _loaded_version['version'] = version
+    return version
+
+
+
+def map_payload(gdf, cols, precision=MAP_PRECISION, report=True) -> dict:
+    """
+    Builds the GeoJSON sent to the browser for the folium map: a single layer whose coordinates are
+    snapped to `precision` decimals and whose properties are only the ratio columns (rounded to one
+    decimal) and the name, shared by styling and tooltips.
+
+    Parameters:
+    - gdf: GeoDataFrame with the features to show.
+    - cols: Ratio columns to carry as properties.
+    - precision: Decimals kept in the coordinates (5 decimals is about one metre).
+    - report: Whether to print the payload size against sending the full-precision layer twice.
+
+    Returns:
+    - GeoJSON FeatureCollection as a dict.
+    """
+    keep = [c for c in ['NOM'] + list(cols) if c in gdf.columns]
+    payload = gdf[keep].copy()
+    for c in cols:
+        payload[c] = payload[c].astype(float).replace([np.inf, -np.inf], np.nan).round(1)
+    # Snapping to the grid already leaves the shortest decimals and drops the vertices it merges
+    geoms = shapely.set_precision(gdf.geometry.values.to_numpy(), 10 ** -precision)
+    payload = gpd.GeoDataFrame(payload, geometry=geoms, crs=gdf.crs)
+    payload.index = range(len(payload))
+
+    geojson = payload.__geo_interface__
+    if report:
+        before = 2 * len(gdf.to_json())
+        after = len(json.dumps(geojson, separators=(',', ':')))
+        print(f"Map payload: {before/1e6:.2f} MB -> {after/1e6:.2f} MB ({100*after/before:.0f}%)")
+    return geojson
+
+
+
+def surface_image(surface, vmin, vmax, cmap_name='Reds', alpha=0.7) -> np.ndarray:
+    """
+    Colours a hotspot surface as an RGBA image, north up, with NaN cells transparent.
+    """
+    norm = mpl.colors.Normalize(vmin=vmin, vmax=vmax)
+    image = mpl.colormaps[cmap_name](norm(np.flipud(surface['ratio'])))
+    image[..., 3] = np.where(np.isnan(np.flipud(surface['ratio'])), 0, alpha)
+    return (255 * image).astype(np.uint8)
+
+
+
+def build_map(gdf, col, surface=None):
+    """
+    Builds the folium map of `col` over the features of `gdf`, as a single GeoJSON layer that
+    carries both the fill colours and the tooltips. A hotspot `surface` of `col` is added as an
+    image layer that can be toggled.
+    """
+    geojson = map_payload(gdf, [col])
+    values = np.array([feature['properties'][col] for feature in geojson['features']], dtype=float)
+    colormap = branca.colormap.linear.Reds_06.scale(np.nanmin(values), np.nanmax(values)).to_step(6)
+    colormap.caption = 'Percentage of Airbnb'
+
+    m = folium.Map(
+        location=[41.3874, 2.1686],
+        zoom_start=13,
+        tiles='CartoDB positron'
+    )
+
+    folium.GeoJson(
+        geojson,
+        style_function=lambda feature: {
+            'fillColor': colormap(feature['properties'][col]) if feature['properties'][col] is not None else 'transparent',
+            'fillOpacity': 0.7,
+            'color': 'black',
+            'weight': 1,
+            'opacity': 0.2,
+        },
+        highlight_function=lambda feature: {'weight': 3, 'fillOpacity': 1},
+        tooltip=folium.GeoJsonTooltip(fields=[col], aliases=["%:"]),
+    ).add_to(m)
+    colormap.add_to(m)
+
+    if surface is not None:
+        minx, miny, maxx, maxy = surface['bounds']
+        folium.raster_layers.ImageOverlay(
+            surface_image(surface, np.nanmin(values), np.nanmax(values)),
+            bounds=[[miny, minx], [maxy, maxx]],
+            mercator_project=True,
+            name='Hotspot density',
+            show=False,
+        ).add_to(m)
+        folium.LayerControl().add_to(m)
+
+    return m
+
+
+
+def build_top_chart(censal, col, type_label):
+    """
+    Builds the horizontal bar chart of the 30 censal sections with the highest `col`.
+    """
+    top_censals = censal.sort_values(col, ascending=False).head(30)
+
+    fig, ax = plt.subplots(figsize=(10, 10))
+    # Increase font size for labels
+    ax.tick_params(axis='y', labelsize=label_fontsize)
+    ax.tick_params(axis='x', labelsize=label_fontsize)
+    # Horizontal bar plot
+    ax.barh(top_censals['NOM'], top_censals[col], color=plt.cm.Reds(top_censals[col] / top_censals[col].max()))
+
+    # Labels and title
+    ax.set_title("Top 30 Censal Sections by %", fontsize=title_fontsize)
+    ax.set_xlabel(f"Percentage of {type_label}", fontsize=label_fontsize)
+    ax.set_ylabel("Neighborhood", fontsize=label_fontsize)
+    ax.set_xticklabels([f"{x:.0f}%" for x in ax.get_xticks()])
+    # Invert y-axis to show the highest ratio on top
+    ax.invert_yaxis()
+    return fig
+
+
+
+def build_hotspot_map(censal, edges, col, surface=None):
+    """
+    Builds the map of the censal sections above HOTSPOT_THRESHOLD over the street network, with some landmarks,
+    and the hotspot `surface` of `col` if given.
+    """
+    # Filter hotspots
+    hottest = censal[censal[col] > HOTSPOT_THRESHOLD]
+    fig_map, ax_map = plt.subplots(figsize=(10, 10))
+    # Plot background edges
+    edges.plot(ax=ax_map, alpha=0.4, color='grey')
+    if len(hottest):
+        # Plot the values
+        plot_ratio_map(hottest, censal, ax_map, ratio_col=col, surface=surface)
+    else:
+        # No section above the threshold (e.g. in an older snapshot): the base alone, with a note
+        censal.plot(ax=ax_map, color='lightgrey', zorder=0)
+        ax_map.text(0.5, 0.95, f"No censal section above {HOTSPOT_THRESHOLD}%", transform=ax_map.transAxes,
+                    fontsize=16, ha='center', va='top', bbox=dict(facecolor='white', edgecolor='none', alpha=0.8))
+        ax_map.set_axis_off()
+
+    ax_map.set_title("A closer look at the most problematic areas", fontsize=title_fontsize)
+    ax_map.set_xlabel("Percentage", fontsize=label_fontsize)
+    ax_map.set_ylabel("Censal Section", fontsize=label_fontsize)
+    ax_map.tick_params(axis='y', labelsize=label_fontsize)
+    ax_map.tick_params(axis='x', labelsize=label_fontsize)
+
+    # Annotate places
+    annotations = [
+            (2.1742309820379906, 41.403593049470885, "Sagrada Familia"),
+            (2.169841171395862, 41.38688665835762, "Plaça Catalunya"),
+            (2.188651884769526, 41.379463437793035, "La Barceloneta"),
+            (2.1633058193393004, 41.36641505140188, "Montjuïc")
+        ]
+    for x, y, name in annotations:
+        ax_map.text(
+            x, y, name,
+            fontsize=16,
+            fontweight='bold',
+            color='black',
+            ha='center',
+            va='center',
+            bbox=dict(
+                facecolor='white',   # Background color
+                edgecolor='none',    # No border
+                boxstyle='round,pad=0.3',  # Rounded box with padding
+                alpha=0.6           # Slight transparency (optional)
+            )
+        )
+    return fig_map
+
+
+
+def _figure_png(fig) -> bytes:
+    buffer = BytesIO()
+    fig.savefig(buffer, format='png', dpi=100)
+    plt.close(fig)
+    return buffer.getvalue()
+
+
+
+def _write(path, content):
+    mode = 'w' if isinstance(content, str) else 'wb'
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, mode) as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+
+def _read(path, binary=False):
+    with open(path, 'rb' if binary else 'r') as f:
+        return f.read()
+
+
+
+def _view_layer(name, date):
+    return load_layer(name, 'map') if date is None else layer_at(name, date)
+
+
+
+@lru_cache(maxsize=None)
+def cached_map(division: str, type_label: str, version: str, date: str = None, render_dir: str = RENDER_DIR) -> str:
+    """
+    Returns the folium map HTML of a (division, type) view, rendering and storing it on first request.
+    With a snapshot `date`, the view shows the counts of that date of the time series.
+    """
+    suffix = '' if date is None else f"_{date}"
+    path = os.path.join(render_dir, version, f"{DIVISIONS[division]}_{TYPES[type_label]}{suffix}.html")
+    if os.path.exists(path):
+        return _read(path)
+
+    with instrument(f"render.map:{DIVISIONS[division]}:{TYPES[type_label]}") as record:
+        layer = _view_layer(DIVISIONS[division], date)
+        record['rows'] = len(layer)
+        # The hotspot surfaces are those of the latest data
+        surface = load_density().get(TYPES[type_label]) if date is None else None
+        html = build_map(layer, TYPES[type_label], surface).get_root().render()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _write(path, html)
+    return html
+
+
+
+@lru_cache(maxsize=None)
+def cached_figures(type_label: str, version: str, date: str = None, render_dir: str = RENDER_DIR) -> dict:
+    """
+    Returns the PNGs of the top-30 chart and the hotspot map of a rental type, rendering and storing
+    them on first request. Both figures are drawn from the censal sections, whatever the division.
+    """
+    stem = os.path.join(render_dir, version, TYPES[type_label] + ('' if date is None else f"_{date}"))
+    paths = {'top_png': stem + '_top.png', 'hotspot_png': stem + '_hotspot.png'}
+    if all(os.path.exists(path) for path in paths.values()):
+        return {key: _read(path, binary=True) for key, path in paths.items()}
+
+    col = TYPES[type_label]
+    censal = _view_layer('censal', date)
+    # The precomputed hotspot edges follow the hotspots of the latest data only
+    edges = load_hotspot_edges(col) if date is None else load_layer('edges', 'map')
+    with _render_lock, instrument(f"render.figures:{col}", rows=len(censal)):
+        figures = {
+            'top_png': _figure_png(build_top_chart(censal, col, type_label)),
+            'hotspot_png': _figure_png(build_hotspot_map(censal, edges, col, load_density().get(col) if date is None else None)),
+        }
+    os.makedirs(os.path.dirname(stem), exist_ok=True)
+    for key, path in paths.items():
+        _write(path, figures[key])
+    return figures
+
+
+
+def cached_view(division: str, type_label: str, version: str, date: str = None, render_dir: str = RENDER_DIR) -> dict:
+    """
+    Returns the outputs of a view from the render cache: 'map_html' (str), 'top_png' and 'hotspot_png' (bytes).
+
+    The cache is keyed by (division, type, data version, snapshot date), so new data files get a new
+    version and are rendered again. Outputs are kept in memory as well, so later requests skip the disk.
+    """
+    return {'map_html': cached_map(division, type_label, version, date, render_dir),
+            **cached_figures(type_label, version, date, render_dir)}
+
+
+
+def warm_render_cache(render_dir: str = RENDER_DIR) -> None:
+    """
+    Renders every (division, type) view of the current data into the render cache.
+    """
+    version = data_version()
+    for division in DIVISIONS:
+        for type_label in TYPES:
+            cached_view(division, type_label, version, render_dir=render_dir)
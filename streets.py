@@ -0,0 +1,94 @@
+import os
+import geopandas as gpd
+import osmnx as ox
+import shapely
+from instrument import instrument
+from app_data import EDGES_PATH, HOTSPOT_THRESHOLD, hotspot_edges_path
+
+
+PLACE = "Barcelona, Barcelona, Spain"
+SIMPLIFY_TOLERANCE = 0.00001 # Degrees, about one metre
+
+# Highway values that are not part of the drive network, used to filter local OSM extracts
+NON_DRIVE_HIGHWAYS = {'abandoned', 'bridleway', 'bus_guideway', 'construction', 'corridor', 'cycleway',
+                      'elevator', 'escalator', 'footway', 'no', 'path', 'pedestrian', 'planned', 'platform',
+                      'proposed', 'raceway', 'razed', 'service', 'steps', 'track'}
+
+
+
+def _first(value):
+    return value[0] if isinstance(value, list) else value
+
+
+
+def load_edges(place: str = PLACE, osm_file: str = None, cache_path: str = EDGES_PATH, bbox=None, force: bool = False) -> gpd.GeoDataFrame:
+    """
+    Loads the drive street network as compact, simplified linestrings, cached as GeoParquet between runs.
+
+    Parameters:
+    - place: Place queried to OpenStreetMap when no `osm_file` is given.
+    - osm_file: Local OSM XML extract (.osm or .osm.bz2) to build the network from, without network access.
+    - cache_path: GeoParquet file holding the edges.
+    - bbox: Optional (minx, miny, maxx, maxy) in EPSG:4326 the edges are clipped to, e.g. the censal bounds.
+    - force: Rebuild the edges even if the cache is up to date.
+
+    Returns:
+    - GeoDataFrame in EPSG:4326 with a 'highway' column and LineString geometries.
+    """
+    fresh = os.path.exists(cache_path) and (osm_file is None or os.path.getmtime(cache_path) >= os.path.getmtime(osm_file))
+    if fresh and not force:
+        return gpd.read_parquet(cache_path)
+
+    with instrument('streets.osm_fetch') as record:
+        if osm_file is not None:
+            print(f"Building street network from '{osm_file}'")
+            # Drop the non-drive ways before simplifying, as the drive network of OpenStreetMap queries does
+            G = ox.graph_from_xml(osm_file, simplify=False)
+            G.remove_edges_from([(u, v, k) for u, v, k, highway in G.edges(keys=True, data='highway')
+                                 if _first(highway) in NON_DRIVE_HIGHWAYS])
+            G.remove_nodes_from([node for node, degree in dict(G.degree()).items() if degree == 0])
+            G = ox.simplify_graph(G)
+        else:
+            print(f"Downloading street network for '{place}'")
+            G = ox.graph_from_place(place, network_type="drive")
+        record['rows'] = G.number_of_edges()
+    edges = ox.graph_to_gdfs(G, nodes=False).to_crs("EPSG:4326")
+    highway = edges['highway'].map(_first).astype(str)
+
+    geoms = shapely.simplify(edges.geometry.values.to_numpy(), SIMPLIFY_TOLERANCE)
+    edges = gpd.GeoDataFrame({'highway': highway.astype('category').to_numpy()}, geometry=geoms, crs="EPSG:4326")
+    if bbox is not None:
+        edges = clip_edges(edges, bbox)
+
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    edges.to_parquet(cache_path, index=False)
+    return edges
+
+
+
+def clip_edges(edges: gpd.GeoDataFrame, bbox) -> gpd.GeoDataFrame:
+    """
+    Clips the edges to a (minx, miny, maxx, maxy) extent, using the spatial index to skip the rest.
+    """
+    candidates = edges.iloc[edges.sindex.query(shapely.box(*bbox))]
+    clipped = shapely.clip_by_rect(candidates.geometry.values.to_numpy(), *bbox)
+    clipped = gpd.GeoDataFrame(candidates.drop(columns=candidates.geometry.name), geometry=clipped, crs=edges.crs)
+    return clipped[~clipped.geometry.is_empty].reset_index(drop=True)
+
+
+
+def write_hotspot_edges(edges: gpd.GeoDataFrame, censal: gpd.GeoDataFrame, cols=('ratio', 'ratio_flats', 'ratio_rooms'),
+                        threshold: float = HOTSPOT_THRESHOLD, margin: float = 0.005, edges_path: str = EDGES_PATH) -> None:
+    """
+    Precomputes, for every ratio column, the edges inside the extent of the censal sections above
+    `threshold` (the area shown by the hotspot map), plus a margin in degrees. A column without
+    hotspots gets an empty file, so the edges of an earlier run are never shown.
+    """
+    for col in cols:
+        hottest = censal[censal[col] > threshold]
+        if hottest.empty:
+            clipped = edges.iloc[:0]
+        else:
+            minx, miny, maxx, maxy = hottest.total_bounds
+            clipped = clip_edges(edges, (minx - margin, miny - margin, maxx + margin, maxy + margin))
+        clipped.to_parquet(hotspot_edges_path(col, edges_path), index=False)
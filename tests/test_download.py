@@ -0,0 +1,119 @@
+import hashlib
+import http.server
+import json
+import os
+import threading
+import zipfile
+import pytest
+import requests
+from catastro.download import download_file, extract_member
+
+PAYLOAD = bytes(range(256)) * 4096 # 1 MiB archive served by the stand-in server
+ETAG = '"v1"'
+
+
+class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Stand-in for the cadastre file server: serves PAYLOAD with an ETag, honouring Range,
+    If-Range and If-None-Match, and records the headers of every request.
+    """
+    seen = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.seen.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range', ETAG) == ETAG:
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            if start >= len(PAYLOAD):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(PAYLOAD)}')
+                self.end_headers()
+                return
+
+        self.send_response(206 if start else 200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(PAYLOAD) - start))
+        if start:
+            self.send_header('Content-Range', f'bytes {start}-{len(PAYLOAD) - 1}/{len(PAYLOAD)}')
+        self.end_headers()
+        self.wfile.write(PAYLOAD[start:])
+
+
+@pytest.fixture
+def url():
+    ArchiveHandler.seen = []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ArchiveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/A.ES.SDGC.BU.08900.zip'
+    server.shutdown()
+    server.server_close()
+
+
+def _leave_partial(url, cache_dir, content):
+    # What an interrupted download leaves behind: the bytes received and the validator of the response
+    partial_dir = os.path.join(cache_dir, 'partial')
+    os.makedirs(partial_dir, exist_ok=True)
+    partial_path = os.path.join(partial_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.zip')
+    with open(partial_path, 'wb') as f:
+        f.write(content)
+    with open(partial_path + '.json', 'w') as f:
+        json.dump({'url': url, 'etag': ETAG, 'last_modified': None}, f)
+    return partial_path
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_download_and_cache_hit(url, tmp_path):
+    path = download_file(url, cache_dir=str(tmp_path), session=requests.Session())
+    assert _read(path) == PAYLOAD
+    assert os.path.basename(path) == hashlib.sha256(PAYLOAD).hexdigest() + '.zip'
+
+    # Revalidation gets a 304 and returns the cached object
+    assert download_file(url, cache_dir=str(tmp_path), session=requests.Session()) == path
+    assert ArchiveHandler.seen[-1]['If-None-Match'] == ETAG
+
+    # Without revalidation the network is not touched at all
+    n_requests = len(ArchiveHandler.seen)
+    assert download_file(url, cache_dir=str(tmp_path), session=requests.Session(), revalidate=False) == path
+    assert len(ArchiveHandler.seen) == n_requests
+
+
+def test_resume(url, tmp_path):
+    partial_path = _leave_partial(url, str(tmp_path), PAYLOAD[:300_000])
+    path = download_file(url, cache_dir=str(tmp_path), session=requests.Session())
+
+    assert ArchiveHandler.seen[0]['Range'] == 'bytes=300000-'
+    assert _read(path) == PAYLOAD
+    assert not os.path.exists(partial_path)
+
+
+def test_complete_partial_is_downloaded_again(url, tmp_path):
+    # A crash after the last chunk leaves a complete partial file, which the server refuses to resume
+    partial_path = _leave_partial(url, str(tmp_path), PAYLOAD)
+    path = download_file(url, cache_dir=str(tmp_path), session=requests.Session())
+
+    assert len(ArchiveHandler.seen) == 2
+    assert 'Range' not in ArchiveHandler.seen[1]
+    assert _read(path) == PAYLOAD
+    assert not os.path.exists(partial_path)
+
+
+def test_extract_member_rejects_paths_outside_output_dir(tmp_path):
+    zip_path = str(tmp_path / 'archive.zip')
+    with zipfile.ZipFile(zip_path, 'w') as z:
+        z.writestr('../evil.building.gml', b'<gml/>')
+
+    with pytest.raises(Exception, match='outside'):
+        extract_member(zip_path, str(tmp_path / 'out'), prefer='building.gml')
+    assert not os.path.exists(tmp_path / 'evil.building.gml')
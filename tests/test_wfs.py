@@ -0,0 +1,127 @@
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+import urllib.parse
+import geopandas as gpd
+import numpy as np
+import pyproj
+import pytest
+import shapely
+from catastro.wfs import WFSClient
+
+CRS = 'EPSG:25830'
+MAX_FEATURES = 150 # Features above which the stand-in server refuses a tile
+TOO_LARGE = (b'<?xml version="1.0"?><ows:ExceptionReport xmlns:ows="http://www.opengis.net/ows/1.1">'
+             b'<ows:Exception exceptionCode="ResultTooLarge"><ows:ExceptionText>Too many features</ows:ExceptionText>'
+             b'</ows:Exception></ows:ExceptionReport>')
+INVALID = (b'<?xml version="1.0"?><ows:ExceptionReport xmlns:ows="http://www.opengis.net/ows/1.1">'
+           b'<ows:Exception exceptionCode="InvalidParameterValue"><ows:ExceptionText>Unknown typeNames</ows:ExceptionText>'
+           b'</ows:Exception></ows:ExceptionReport>')
+
+_to_crs = pyproj.Transformer.from_crs('EPSG:4326', CRS, always_xy=True)
+_from_crs = pyproj.Transformer.from_crs(CRS, 'EPSG:4326', always_xy=True)
+X0, Y0 = _to_crs.transform(2.15, 41.38)
+
+
+def _parcels(n=800, side=1500, seed=0):
+    rng = np.random.default_rng(seed)
+    x, y = rng.uniform(X0, X0 + side, n), rng.uniform(Y0, Y0 + side, n)
+    return gpd.GeoDataFrame({'localId': [f'REF{i:05d}' for i in range(n)]},
+                            geometry=shapely.box(x, y, x + 30, y + 30), crs=CRS)
+
+
+class WFSHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Stand-in for the cadastre WFS: answers GetFeature by bounding box with the parcels intersecting it
+    as GML, refusing tiles with more than MAX_FEATURES, or every request when `invalid` is set.
+    """
+    parcels = None
+    invalid = False
+    seen = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+        self.seen.append(query['bbox'])
+        minx, miny, maxx, maxy = map(float, query['bbox'].split(',')[:4])
+        selected = self.parcels[self.parcels.intersects(shapely.box(minx, miny, maxx, maxy))]
+        if self.invalid:
+            body = INVALID
+        elif len(selected) > MAX_FEATURES:
+            body = TOO_LARGE
+        else:
+            folder = tempfile.mkdtemp()
+            try:
+                selected.to_file(os.path.join(folder, 'tile.gml'), driver='GML', FORMAT='GML3')
+                with open(os.path.join(folder, 'tile.gml'), 'rb') as f:
+                    body = f.read()
+            finally:
+                shutil.rmtree(folder)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def client(tmp_path):
+    WFSHandler.parcels = _parcels()
+    WFSHandler.invalid = False
+    WFSHandler.seen = []
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), WFSHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield WFSClient(url=f'http://127.0.0.1:{server.server_port}/wfs', crs=CRS, cache_dir=str(tmp_path), retries=0)
+    server.shutdown()
+    server.server_close()
+
+
+def _area(side=800):
+    lon, lat = _from_crs.transform(X0 + side, Y0 + side)
+    return (2.15, 41.38, lon, lat)
+
+
+def _expected(area):
+    parcels = WFSHandler.parcels.to_crs('EPSG:4326')
+    return set(parcels.loc[parcels.intersects(shapely.box(*area)), 'localId'])
+
+
+@pytest.mark.parametrize('tiling', ['bbox', 'h3'])
+def test_fetch_deduplicates_tiles(client, tiling):
+    area = _area()
+    parcels = client.fetch(area, tiling=tiling, tile_size=300)
+
+    # Parcels crossing tile borders are fetched by several tiles but returned once
+    assert parcels['parcel_id'].is_unique
+    assert set(parcels['parcel_id']) == _expected(area)
+    assert parcels.crs == 'EPSG:4326'
+
+
+def test_cached_rerun_makes_no_requests(client):
+    area = _area()
+    first = client.fetch(area, tile_size=300)
+    assert len(WFSHandler.seen) > 0
+
+    WFSHandler.seen.clear()
+    second = client.fetch(area, tile_size=300)
+    assert WFSHandler.seen == []
+    assert set(second['parcel_id']) == set(first['parcel_id'])
+
+
+def test_tiles_with_too_many_features_are_split(client):
+    area = _area(1500)
+    parcels = client.fetch(area, tile_size=1500)
+
+    # The single tile is refused and split until its quarters fit
+    assert len(WFSHandler.seen) > 1
+    assert set(parcels['parcel_id']) == _expected(area)
+
+
+def test_other_exception_reports_are_not_split(client):
+    WFSHandler.invalid = True
+    with pytest.raises(Exception, match='InvalidParameterValue'):
+        client.fetch(_area(), tile_size=1000)
+    assert len(WFSHandler.seen) == 1
@@ -0,0 +1,129 @@
+import glob
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import geopandas as gpd
+import pandas as pd
+from tqdm import tqdm
+from listings import read_listings
+from utils import count_houses, roll_up
+
+
+SNAPSHOT_PATTERNS = ('*.csv', '*.csv.gz') # Listing files searched for in a snapshot directory, at any depth
+COUNT_COLS = ['n_parcels', 'n_flats', 'n_rooms']
+RATIO_COLS = ['ratio_flats', 'ratio_rooms', 'ratio']
+
+_DATE = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+
+# Censal sections of the worker processes, sent once per worker instead of once per snapshot
+_worker_sections = None
+
+
+
+def snapshot_date(path: str) -> str:
+    """
+    Date of an Inside Airbnb snapshot as 'YYYY-MM-DD', read from the last date in its path,
+    e.g. 'snapshots/2025-03-12/listings.csv.gz' or 'snapshots/listings_2025-03-12.csv'.
+    """
+    dates = _DATE.findall(path)
+    if not dates:
+        raise Exception(f"No YYYY-MM-DD date in the path of the snapshot '{path}'.")
+    return '-'.join(dates[-1])
+
+
+
+def snapshot_paths(snapshot_dir: str) -> list:
+    """
+    Listing files of a directory of snapshots, sorted by date.
+    """
+    paths = {path for pattern in SNAPSHOT_PATTERNS
+             for path in glob.glob(os.path.join(snapshot_dir, '**', pattern), recursive=True)}
+    return sorted((path for path in paths if _DATE.search(path)), key=snapshot_date)
+
+
+
+def division_code(gdf: gpd.GeoDataFrame, division: str) -> pd.Series:
+    """
+    Code identifying every feature of a division: district and section numbers for the censal
+    sections (e.g. '02001'), and the 'BARRI' and 'DISTRICTE' codes for barris and districts.
+    """
+    if division == 'censal':
+        return gdf['DISTRICTE'].astype(str) + gdf['SEC_CENS'].astype(str)
+    return gdf[{'barris': 'BARRI', 'districts': 'DISTRICTE'}[division]].astype(str)
+
+
+
+def _init_worker(sections, method, tie_rule):
+    global _worker_sections
+    _worker_sections = (sections, method, tie_rule)
+
+
+
+def _count_snapshot(path: str) -> pd.DataFrame:
+    sections, method, tie_rule = _worker_sections
+    listings = read_listings(path)
+    for out_label, basic in (('n_flats', 'Flat'), ('n_rooms', 'Room')):
+        sections = count_houses(listings[listings['property_type_basic'] == basic], sections, out_label,
+                                parcel_id_col='id', method=method, tie_rule=tie_rule)
+    return sections[['n_flats', 'n_rooms']]
+
+
+
+def count_snapshots(snapshot_dir: str,
+                    censal: gpd.GeoDataFrame,
+                    barris: gpd.GeoDataFrame,
+                    districts: gpd.GeoDataFrame,
+                    n_parcels: pd.Series,
+                    max_workers: int = None,
+                    method: str = 'intersects',
+                    tie_rule: str = 'representative_point') -> pd.DataFrame:
+    """
+    Counts every listings snapshot of a directory per censal section in a process pool, and rolls
+    the counts up to barris and districts as a long-format time series.
+
+    The dwellings per censal section do not change between snapshots, so they are given once as
+    `n_parcels` and shared by every snapshot.
+
+    Parameters:
+    - snapshot_dir: Directory with one Inside Airbnb listings file per snapshot, see `snapshot_paths`.
+    - censal, barris, districts: Divisions, as in `count_hierarchy`.
+    - n_parcels: Dwellings per censal section, aligned with the index of `censal`.
+    - max_workers: Processes of the pool (defaults to the number of CPUs).
+    - method, tie_rule: Listing-to-section assignment, see `assign_sections`.
+
+    Returns:
+    - DataFrame with one row per (date, division, code) and the columns 'date', 'division', 'code',
+      'NOM', the counts in COUNT_COLS and the ratios in RATIO_COLS.
+
+    Raises:
+    - Exception: If two snapshot files have the same date.
+    """
+    paths = snapshot_paths(snapshot_dir)
+    dates = pd.Series([snapshot_date(path) for path in paths], index=paths, dtype=object)
+    duplicated = dates[dates.duplicated(keep=False)]
+    if not duplicated.empty:
+        raise Exception(f"Several snapshots share a date, keep one file per date: {', '.join(duplicated.index)}")
+    sections = censal[[censal.geometry.name]]
+
+    counts = {}
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(sections, method, tie_rule)) as executor:
+        futures = {executor.submit(_count_snapshot, path): path for path in paths}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            counts[snapshot_date(futures[future])] = future.result()
+
+    frames = []
+    for date in sorted(counts):
+        snapshot = censal.copy()
+        snapshot['n_parcels'] = n_parcels
+        snapshot[['n_flats', 'n_rooms']] = counts[date]
+        levels = roll_up(snapshot, barris, districts, COUNT_COLS)
+        for division, gdf in zip(('censal', 'barris', 'districts'), levels):
+            frame = pd.DataFrame(gdf[['NOM'] + COUNT_COLS + RATIO_COLS])
+            frame.insert(0, 'code', division_code(gdf, division).to_numpy())
+            frame.insert(0, 'division', division)
+            frame.insert(0, 'date', date)
+            frames.append(frame)
+
+    if not frames:
+        return pd.DataFrame(columns=['date', 'division', 'code', 'NOM'] + COUNT_COLS + RATIO_COLS)
+    return pd.concat(frames, ignore_index=True)
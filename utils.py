@@ -3,6 +3,219 @@ import geopandas as gpd
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 import numpy as np
+import shapely
+import time
+from instrument import instrument
+
+
+
+def assign_sections(parcels: gpd.GeoDataFrame,
+                    censal: gpd.GeoDataFrame,
+                    parcel_id_col: str = 'parcel_id',
+                    method: str = 'intersects',
+                    tie_rule: str = 'representative_point') -> pd.Series:
+    """
+    Assigns each parcel to a single censal section.
+
+    Parameters:
+    - parcels: GeoDataFrame with parcel geometries.
+    - censal: GeoDataFrame with censal section geometries.
+    - parcel_id_col: Column name used as a unique parcel ID. Parcels sharing an ID are counted once.
+    - method: 'intersects' joins full parcel geometries and keeps the first matching section.
+      'point' queries a representative point of every parcel against a prepared STRtree.
+    - tie_rule: Only used with method='point'. 'representative_point' keeps the section holding
+      the representative point, 'largest_overlap' gives parcels straddling several sections
+      to the one they overlap the most.
+
+    Returns:
+    - Series aligned with `parcels` holding the index label of the assigned censal section (NaN if none).
+      With method='point', `attrs['n_straddling']` holds the number of parcels intersecting more than one section.
+    """
+
+    if method == 'intersects':
+        # Perform spatial join, carrying only the columns we need
+        joined = gpd.sjoin(parcels[[parcel_id_col, parcels.geometry.name]], censal[[censal.geometry.name]], how='inner', predicate='intersects')
+
+        # Drop duplicates to ensure each parcel is counted once
+        joined_unique = joined.drop_duplicates(subset=parcel_id_col)
+
+        return joined_unique['index_right'].reindex(parcels.index)
+
+    if method != 'point':
+        raise ValueError(f"Unknown assignment method '{method}'. Use 'intersects' or 'point'.")
+    if tie_rule not in ('representative_point', 'largest_overlap'):
+        raise ValueError(f"Unknown tie rule '{tie_rule}'. Use 'representative_point' or 'largest_overlap'.")
+
+    geoms = parcels.geometry.values.to_numpy()
+    sections = censal.geometry.values.to_numpy()
+    shapely.prepare(sections)
+
+    # Vectorized point-in-polygon of the representative points: the points go in the STRtree
+    # and each prepared section is queried once. Points lying exactly on a border are left for
+    # the overlap check below.
+    points = shapely.point_on_surface(geoms)
+    section_idx, point_idx = shapely.STRtree(points).query(sections, predicate='contains')
+    position = np.full(len(geoms), -1, dtype=np.int64)
+    order = np.lexsort((section_idx, point_idx))
+    first = np.unique(point_idx[order], return_index=True)[1]
+    position[point_idx[order][first]] = section_idx[order][first]
+
+    # Only parcels whose bounding box touches more than one section and that are not covered
+    # by their assigned section can straddle. Parcels whose representative point falls outside
+    # every section (e.g. on a border or across the outer boundary) are checked as well.
+    n_boxes = np.bincount(shapely.STRtree(geoms).query(sections)[1], minlength=len(geoms))
+    check = np.flatnonzero((n_boxes > 1) & (position >= 0))
+    check = check[~shapely.covers(sections[position[check]], geoms[check])]
+    candidates = np.union1d(check, np.flatnonzero((n_boxes > 0) & (position < 0)))
+    cand_section, cand_idx = shapely.STRtree(geoms[candidates]).query(sections, predicate='intersects')
+    cand_idx = candidates[cand_idx]
+    straddling = np.flatnonzero(np.bincount(cand_idx, minlength=len(geoms)) > 1)
+
+    # Resolve by largest overlap, lowest section position on equal overlap
+    resolve = position < 0
+    if tie_rule == 'largest_overlap':
+        resolve[straddling] = True
+    keep = resolve[cand_idx]
+    cand_idx, cand_section = cand_idx[keep], cand_section[keep]
+    if len(cand_idx) > 0:
+        overlap = shapely.area(shapely.intersection(geoms[cand_idx], sections[cand_section]))
+        order = np.lexsort((cand_section, -overlap, cand_idx))
+        first = np.unique(cand_idx[order], return_index=True)[1]
+        position[cand_idx[order][first]] = cand_section[order][first]
+
+    assigned = pd.Series(position, index=parcels.index)
+    assigned = assigned[assigned >= 0]
+    assigned = assigned[~parcels.loc[assigned.index, parcel_id_col].duplicated().to_numpy()]
+
+    result = pd.Series(censal.index[assigned.to_numpy()], index=assigned.index).reindex(parcels.index)
+    result.attrs['n_straddling'] = len(straddling)
+    return result
+
+
+
+def compare_assignment(parcels: gpd.GeoDataFrame,
+                       censal: gpd.GeoDataFrame,
+                       parcel_id_col: str = 'parcel_id',
+                       apartments_col: str = None,
+                       tie_rule: str = 'representative_point',
+                       sample: int = None) -> pd.DataFrame:
+    """
+    Runs the 'intersects' and 'point' assignment methods on the same data, prints the
+    throughput of each and returns the per-section counts of both.
+
+    Parameters:
+    - parcels, censal, parcel_id_col, apartments_col: As in `count_houses`.
+    - tie_rule: Tie rule passed to the 'point' method.
+    - sample: Number of parcels drawn at random to compare on (None compares all of them).
+
+    Returns:
+    - DataFrame indexed like `censal` with columns 'intersects', 'point' and 'change'.
+    """
+
+    if sample is not None and sample < len(parcels):
+        parcels = parcels.sample(sample, random_state=0)
+
+    counts = {}
+    elapsed = {}
+    for method in ('intersects', 'point'):
+        start = time.perf_counter()
+        counted = count_houses(parcels, censal, out_label=method, parcel_id_col=parcel_id_col,
+                               apartments_col=apartments_col, method=method, tie_rule=tie_rule)
+        elapsed[method] = time.perf_counter() - start
+        counts[method] = counted[method]
+
+    comparison = pd.DataFrame(counts)
+    comparison['change'] = comparison['point'] - comparison['intersects']
+
+    for method, seconds in elapsed.items():
+        print(f"{method}: {seconds:.2f} s ({len(parcels)/seconds:,.0f} parcels/s)")
+    print(f"Speedup of 'point' over 'intersects': {elapsed['intersects']/elapsed['point']:.1f}x")
+    print(f"Sections with a different count: {(comparison['change'] != 0).sum()} of {len(comparison)}, "
+          f"total change: {comparison['change'].sum():+d}, largest change: {comparison['change'].abs().max()}")
+
+    return comparison
+
+
+
+def add_ratios(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    Adds the percentage columns 'ratio_flats', 'ratio_rooms' and 'ratio' computed
+    from the 'n_flats', 'n_rooms' and 'n_parcels' columns.
+    """
+    gdf['ratio_flats'] = 100*gdf['n_flats'] / gdf['n_parcels']
+    gdf['ratio_rooms'] = 100*gdf['n_rooms'] / gdf['n_parcels']
+    gdf['ratio'] = 100*(gdf['n_flats']+gdf['n_rooms']) / gdf['n_parcels']
+    return gdf
+
+
+
+def count_hierarchy(layers: dict,
+                    censal: gpd.GeoDataFrame,
+                    barris: gpd.GeoDataFrame,
+                    districts: gpd.GeoDataFrame,
+                    barri_col: str = 'BARRI',
+                    district_col: str = 'DISTRICTE',
+                    method: str = 'intersects',
+                    tie_rule: str = 'representative_point'):
+    """
+    Counts every input layer per censal section with a single spatial join each, and rolls
+    the counts up to barris and districts through the codes stored on the censal sections.
+
+    Parameters:
+    - layers: dict mapping an output label to a tuple (gdf, parcel_id_col, apartments_col),
+      with the same meaning as the arguments of `count_houses`.
+    - censal: GeoDataFrame with censal section geometries and `barri_col`/`district_col` codes.
+    - barris: GeoDataFrame with barri geometries and a `barri_col` code.
+    - districts: GeoDataFrame with district geometries and a `district_col` code.
+    - method, tie_rule: Parcel-to-section assignment, see `assign_sections`.
+
+    Returns:
+    - Tuple (censal, barris, districts) of copies with one column per layer and, when the
+      labels 'n_parcels', 'n_flats' and 'n_rooms' are present, the ratio columns.
+    """
+
+    censal = censal.copy()
+    for out_label, (gdf, parcel_id_col, apartments_col) in layers.items():
+        censal = count_houses(gdf, censal, out_label=out_label, parcel_id_col=parcel_id_col, apartments_col=apartments_col,
+                              method=method, tie_rule=tie_rule)
+
+    # Roll up through the codes of the censal sections
+    return roll_up(censal, barris, districts, list(layers), barri_col=barri_col, district_col=district_col)
+
+
+
+def roll_up(censal: gpd.GeoDataFrame,
+            barris: gpd.GeoDataFrame,
+            districts: gpd.GeoDataFrame,
+            cols: list,
+            barri_col: str = 'BARRI',
+            district_col: str = 'DISTRICTE'):
+    """
+    Rolls count columns of the censal sections up to barris and districts through the codes
+    stored on the censal sections.
+
+    Parameters:
+    - censal: GeoDataFrame with the count columns and `barri_col`/`district_col` codes.
+    - barris: GeoDataFrame with barri geometries and a `barri_col` code.
+    - districts: GeoDataFrame with district geometries and a `district_col` code.
+    - cols: Count columns of `censal` to roll up.
+
+    Returns:
+    - Tuple (censal, barris, districts) with the rolled up columns and, when the columns
+      'n_parcels', 'n_flats' and 'n_rooms' are present, the ratio columns.
+    """
+    barris = barris.copy()
+    districts = districts.copy()
+    for col in cols:
+        per_barri = censal.groupby(barri_col)[col].sum()
+        per_district = censal.groupby(district_col)[col].sum()
+        barris[col] = barris[barri_col].map(per_barri).fillna(0).astype(int)
+        districts[col] = districts[district_col].map(per_district).fillna(0).astype(int)
+
+    if {'n_parcels', 'n_flats', 'n_rooms'}.issubset(cols):
+        censal, barris, districts = (add_ratios(gdf) for gdf in (censal, barris, districts))
+
+    return censal, barris, districts
 
 
 
@@ -10,7 +223,9 @@ def count_houses(parcels: gpd.GeoDataFrame,
                                  censal: gpd.GeoDataFrame,
                                  out_label: str , 
                                  parcel_id_col: str = 'parcel_id', 
-                                 apartments_col: str = None) -> gpd.GeoDataFrame:
+                                 apartments_col: str = None,
+                                 method: str = 'intersects',
+                                 tie_rule: str = 'representative_point') -> gpd.GeoDataFrame:
     """
     Counts total number of apartments (or parcels, if apartments_col is None)
     intersecting each censal section.
@@ -20,6 +235,7 @@ def count_houses(parcels: gpd.GeoDataFrame,
     - censal: GeoDataFrame with censal section geometries.
     - parcel_id_col: Column name to use as a unique parcel ID (defaults to 'parcel_id').
     - apartments_col: Column with apartment counts per parcel. If None, each parcel counts as 1 apartment.
+    - method, tie_rule: Parcel-to-section assignment, see `assign_sections`.
 
     Returns:
     - censal GeoDataFrame with added 'n_apartments' column.
@@ -39,14 +255,14 @@ def count_houses(parcels: gpd.GeoDataFrame,
         # Ensure apartment counts are numeric
         parcels[apartments_col] = pd.to_numeric(parcels[apartments_col], errors='coerce').fillna(0)
 
-    # Perform spatial join
-    joined = gpd.sjoin(parcels, censal, how='inner', predicate='intersects')
+    with instrument(f"count_houses:{out_label}", rows=len(parcels)):
+        # Assign each parcel to a single censal section
+        sections = assign_sections(parcels, censal, parcel_id_col=parcel_id_col, method=method, tie_rule=tie_rule)
+        if 'n_straddling' in sections.attrs:
+            print(f"{out_label}: {sections.attrs['n_straddling']} parcels straddle more than one censal section")
 
-    # Drop duplicates to ensure each parcel is counted once
-    joined_unique = joined.drop_duplicates(subset=parcel_id_col)
-
-    # Sum apartments per censal section
-    apartments_per_censal = joined_unique.groupby('index_right')[apartments_col].sum()
+        # Sum apartments per censal section
+        apartments_per_censal = parcels[apartments_col].groupby(sections).sum()
 
     # Add result to censal GeoDataFrame
     censal = censal.copy()
@@ -60,7 +276,7 @@ def count_houses(parcels: gpd.GeoDataFrame,
 
 
 
-def plot_ratio_map(gdf, base_gdf, ax, ratio_col='ratio', cmap_name='Reds', n_ticks=6, title="Ratio of Airbnb Flats to Parcels per Censal Section"):
+def plot_ratio_map(gdf, base_gdf, ax, ratio_col='ratio', cmap_name='Reds', n_ticks=6, title="Ratio of Airbnb Flats to Parcels per Censal Section", surface=None, base_image=None):
     """
     Plots a choropleth map showing the ratio column from `gdf` over a base layer `base_gdf`.
 
@@ -71,6 +287,10 @@ def plot_ratio_map(gdf, base_gdf, ax, ratio_col='ratio', cmap_name='Reds', n_tic
         cmap_name (str): Name of matplotlib colormap.
         n_ticks (int): Number of ticks on the colorbar.
         title (str): Title of the plot.
+        surface (dict, optional): Hotspot surface of `ratio_col` (see density.density_surface), drawn
+            over the base layer with the same colours; the polygons of `gdf` are then only outlined.
+        base_image (dict, optional): Pre-rendered base layer with 'image' (RGBA array) and 'bounds'
+            (see export_maps.render_base), drawn instead of `base_gdf`, which can then be None.
     """
 
     # Get min and max of ratio
@@ -85,23 +305,34 @@ def plot_ratio_map(gdf, base_gdf, ax, ratio_col='ratio', cmap_name='Reds', n_tic
 
     # Set up color normalization and colormap
     norm = mpl.colors.Normalize(vmin=vmin, vmax=vmax)
-    cmap = plt.cm.get_cmap(cmap_name)
+    cmap = mpl.colormaps[cmap_name]
     sm = mpl.cm.ScalarMappable(cmap=cmap, norm=norm)
     sm.set_array([])
 
     # Base layer
-    base_gdf.plot(ax = ax, color='lightgrey', figsize=(10, 10))
-
-    # Foreground: colored polygons
-    gdf.plot(
-        column=ratio_col,
-        ax=ax,
-        cmap=cmap,
-        norm=norm,
-        edgecolor='black',
-        alpha=0.5,
-        legend=False
-    )
+    if base_image is not None:
+        minx, miny, maxx, maxy = base_image['bounds']
+        ax.imshow(base_image['image'], extent=(minx, maxx, miny, maxy), interpolation='antialiased', zorder=0)
+    else:
+        base_gdf.plot(ax = ax, color='lightgrey', figsize=(10, 10))
+
+    if surface is not None:
+        # Continuous surface, on the same colour scale as the polygons
+        minx, miny, maxx, maxy = surface['bounds']
+        ax.imshow(surface['ratio'], origin='lower', extent=(minx, maxx, miny, maxy), cmap=cmap, norm=norm,
+                  alpha=0.7, interpolation='bilinear', zorder=1)
+        gdf.boundary.plot(ax=ax, color='black', linewidth=0.8, zorder=2)
+    else:
+        # Foreground: colored polygons
+        gdf.plot(
+            column=ratio_col,
+            ax=ax,
+            cmap=cmap,
+            norm=norm,
+            edgecolor='black',
+            alpha=0.5,
+            legend=False
+        )
 
     # Custom colorbar
     cbar = plt.colorbar(sm, ax=ax, fraction=0.03, pad=0.04)